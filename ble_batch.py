@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import ble_uuid as UUID
+import ble_parser
+
+'''
+Batch decoding into NumPy columns
+
+decodes many raw payloads of one characteristic in a single vectorized
+pass, for post-session analysis of captured notifications.
+
+fields that are absent in a packet (None in the ble_parser records) are
+-1 in the integer columns. RR intervals are ragged, so they come as one
+flat 'rr' array plus 'rr_offset' (length N + 1): the intervals of packet
+i are rr[rr_offset[i]:rr_offset[i + 1]].
+'''
+
+PAD = 12  # spare columns so fixed-offset reads never leave the matrix
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("ble_batch requires numpy")
+
+
+def to_matrix(payloads):
+    # payloads -> (uint8 matrix N x width zero padded, lengths)
+    lengths = np.fromiter((len(value) for value in payloads),
+                          dtype=np.int64, count=len(payloads))
+    width = (int(lengths.max()) if len(lengths) else 0) + PAD
+    matrix = np.zeros((len(payloads), width), dtype=np.uint8)
+
+    flat = np.frombuffer(b''.join(bytes(value) for value in payloads),
+                         dtype=np.uint8)
+    mask = np.arange(width)[np.newaxis, :] < lengths[:, np.newaxis]
+    matrix[mask] = flat  # row-major order of mask == concatenation order
+    return matrix, lengths
+
+
+def read_uint16(matrix, rows, offset):
+    return matrix[rows, offset].astype(np.int64) | \
+        (matrix[rows, offset + 1].astype(np.int64) << 8)
+
+
+def read_uint32(matrix, rows, offset):
+    return read_uint16(matrix, rows, offset) | \
+        (read_uint16(matrix, rows, offset + 2) << 16)
+
+
+def to_timestamps(timestamps, count):
+    if timestamps is None:
+        return np.full(count, np.nan)
+    return np.asarray(timestamps, dtype=np.float64)
+
+
+def decode_hrm_meas(payloads, timestamps=None):
+    require_numpy()
+    matrix, lengths = to_matrix(payloads)
+    count = len(payloads)
+    rows = np.arange(count)
+
+    flags = matrix[:, 0].astype(np.int64)
+    is_uint16 = (flags & ble_parser.HRM_FLAG_UINT16) != 0
+    bpm = np.where(is_uint16, read_uint16(matrix, rows, 1), matrix[:, 1])
+    offset = np.where(is_uint16, 3, 2)
+
+    contact = np.where(flags & ble_parser.HRM_FLAG_CONTACT_SUPPORTED,
+                       (flags & ble_parser.HRM_FLAG_CONTACT) != 0, -1)
+
+    has_energy = (flags & ble_parser.HRM_FLAG_ENERGY) != 0
+    energy = np.where(has_energy, read_uint16(matrix, rows, offset), -1)
+    offset = offset + np.where(has_energy, 2, 0)
+
+    has_rr = (flags & ble_parser.HRM_FLAG_RR) != 0
+    rr_count = np.where(has_rr, np.maximum(lengths - offset, 0) >> 1, 0)
+    rr_offset = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(rr_count, out=rr_offset[1:])
+
+    rr_rows = np.repeat(rows, rr_count)
+    rr_index = np.arange(rr_offset[-1]) - np.repeat(rr_offset[:-1], rr_count)
+    rr = read_uint16(matrix, rr_rows, offset[rr_rows] + 2 * rr_index)
+
+    return {
+        "timestamp": to_timestamps(timestamps, count),
+        "valid": lengths >= offset,
+        "flags": flags,
+        "bpm": bpm.astype(np.int64),
+        "contact": contact.astype(np.int8),
+        "energy": energy,
+        "rr": rr,
+        "rr_offset": rr_offset,
+    }
+
+
+def decode_speed_csc_meas(payloads, timestamps=None):
+    require_numpy()
+    matrix, lengths = to_matrix(payloads)
+    count = len(payloads)
+    rows = np.arange(count)
+
+    flags = matrix[:, 0].astype(np.int64)
+    has_wheel = (flags & ble_parser.CSC_FLAG_WHEEL) != 0
+    has_crank = (flags & ble_parser.CSC_FLAG_CRANK) != 0
+
+    wheel_rev = np.where(has_wheel, read_uint32(matrix, rows, 1), -1)
+    wheel_time = np.where(has_wheel, read_uint16(matrix, rows, 5), -1)
+
+    offset = np.where(has_wheel, 7, 1)
+    crank_rev = np.where(has_crank, read_uint16(matrix, rows, offset), -1)
+    crank_time = np.where(has_crank,
+                          read_uint16(matrix, rows, offset + 2), -1)
+    offset = offset + np.where(has_crank, 4, 0)
+
+    return {
+        "timestamp": to_timestamps(timestamps, count),
+        "valid": lengths >= offset,
+        "flags": flags,
+        "wheel_rev": wheel_rev,
+        "wheel_time": wheel_time,
+        "crank_rev": crank_rev,
+        "crank_time": crank_time,
+    }
+
+
+def decode_integer(payloads, timestamps=None):
+    require_numpy()
+    matrix, lengths = to_matrix(payloads)
+    count = len(payloads)
+
+    value = np.zeros(count, dtype=np.uint64)
+    for index in range(min(matrix.shape[1] - PAD, 8)):
+        byte = np.where(lengths > index, matrix[:, index], 0)
+        value |= byte.astype(np.uint64) << np.uint64(8 * index)
+
+    return {
+        "timestamp": to_timestamps(timestamps, count),
+        "valid": (lengths > 0) & (lengths <= 8),
+        "value": value,
+    }
+
+
+def decode_parser(parse_func, payloads, timestamps=None):
+    # no vectorized layout (strings): per packet, into an object column
+    require_numpy()
+    count = len(payloads)
+    value = np.empty(count, dtype=object)
+    for index, payload in enumerate(payloads):
+        value[index] = parse_func(None, payload, 0.0).value
+
+    return {
+        "timestamp": to_timestamps(timestamps, count),
+        "valid": np.ones(count, dtype=bool),
+        "value": value,
+    }
+
+
+batch_decoder_dict = {
+    ble_parser.parse_hrm_meas: decode_hrm_meas,
+    ble_parser.parse_speed_csc_meas: decode_speed_csc_meas,
+    ble_parser.parse_integer: decode_integer,
+}
+
+
+def decode(uuid, payloads, timestamps=None):
+    parse_func = ble_parser.uuid_to_parser_dict.get(uuid, None)
+    if parse_func is None:
+        raise ValueError("Unknown uuid: {}".format(uuid))
+
+    decoder = batch_decoder_dict.get(parse_func, None)
+    if decoder is None:
+        return decode_parser(parse_func, payloads, timestamps)
+    return decoder(payloads, timestamps)
+
+
+'''
+Verification against the per-packet parsers
+'''
+
+
+def to_optional(value):
+    value = int(value)
+    return None if value < 0 else value
+
+
+def column_records(uuid, columns):
+    # rebuild the per-packet field tuples (without id/timestamp)
+    parse_func = ble_parser.uuid_to_parser_dict[uuid]
+    count = len(columns["timestamp"])
+
+    if parse_func is ble_parser.parse_hrm_meas:
+        rr_offset = columns["rr_offset"]
+        for i in range(count):
+            contact = int(columns["contact"][i])
+            yield (int(columns["bpm"][i]),
+                   None if contact < 0 else bool(contact),
+                   to_optional(columns["energy"][i]),
+                   tuple(int(rr) for rr in
+                         columns["rr"][rr_offset[i]:rr_offset[i + 1]]))
+    elif parse_func is ble_parser.parse_speed_csc_meas:
+        for i in range(count):
+            yield (to_optional(columns["wheel_rev"][i]),
+                   to_optional(columns["wheel_time"][i]),
+                   to_optional(columns["crank_rev"][i]),
+                   to_optional(columns["crank_time"][i]))
+    elif parse_func is ble_parser.parse_integer:
+        for i in range(count):
+            yield (int(columns["value"][i]),)
+    else:
+        for i in range(count):
+            yield (columns["value"][i],)
+
+
+def verify(uuid, payloads):
+    # returns the indexes where batch and per-packet decoding disagree
+    parse_func = ble_parser.uuid_to_parser_dict[uuid]
+    columns = decode(uuid, payloads)
+
+    mismatch = []
+    for i, fields in enumerate(column_records(uuid, columns)):
+        if not columns["valid"][i]:
+            continue
+        record = parse_func(None, payloads[i], 0.0)
+        if record is None or tuple(record[2:]) != fields:
+            mismatch.append(i)
+    return mismatch
+
+
+if __name__ == '__main__':
+    import random
+    import struct
+
+    require_numpy()
+    hrm_payloads = []
+    for i in range(10000):
+        flags = random.randint(0, 0x1f)
+        payload = bytearray([flags])
+        payload += struct.pack('<H' if flags & 0x01 else '<B',
+                               random.randint(40, 200))
+        if flags & 0x08:
+            payload += struct.pack('<H', random.randint(0, 0xffff))
+        if flags & 0x10:
+            for j in range(random.randint(0, 4)):
+                payload += struct.pack('<H', random.randint(500, 1200))
+        hrm_payloads.append(bytes(payload))
+
+    csc_payloads = []
+    for i in range(10000):
+        flags = random.randint(0, 3)
+        payload = bytearray([flags])
+        if flags & 0x01:
+            payload += struct.pack('<IH', random.randint(0, 0xffffffff),
+                                   random.randint(0, 0xffff))
+        if flags & 0x02:
+            payload += struct.pack('<HH', random.randint(0, 0xffff),
+                                   random.randint(0, 0xffff))
+        csc_payloads.append(bytes(payload))
+
+    print("hrm mismatch: {}".format(
+        len(verify(UUID.CHRC_HRM_HR_MEAS, hrm_payloads))))
+    print("csc mismatch: {}".format(
+        len(verify(UUID.CHRC_SPEED_CSC_MEAS, csc_payloads))))
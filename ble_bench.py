@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import ble_uuid as UUID
+import ble_parser
+
+'''
+Microbenchmark for ble_parser
+
+legacy_* are the list/slice based parsers as they used to be; the log
+message they always built is kept, only the logger output is dropped
+'''
+
+
+def legacy_log(message):
+    return message
+
+
+def legacy_parse_string(id, value):
+    value_str = ''.join([chr(byte) for byte in value])
+    legacy_log("{}\t-> {}".format(id, value_str))
+
+
+def legacy_parse_integer(id, value):
+    value_int = int.from_bytes(value, byteorder='little', signed=False)
+    legacy_log("{}\t -> {}".format(id, value_int))
+
+
+def legacy_parse_speed_csc_meas(id, value):
+    flags = value[0]
+    wheel_status = flags & 0x01
+    if wheel_status != 1:
+        return
+    tmp = value[1:5]
+    wheel_rev = int.from_bytes(tmp, byteorder='little', signed=False)
+    tmp = value[5:7]
+    update_time = int.from_bytes(tmp, byteorder='little', signed=False)
+    update_time /= 1024.0
+    legacy_log("{}\t-> wh_rev:{}\tupdate_time:{}".
+               format(id, wheel_rev, update_time))
+
+
+def legacy_parse_hrm_meas(id, value):
+    flags = value[0]
+    hr_value_fmt = flags & 0x01
+    if hr_value_fmt == 1:
+        tmp = value[1:3]
+        hrm_meas = int.from_bytes(tmp, byteorder='little', signed=False)
+    else:
+        tmp = value[1]
+        hrm_meas = int(tmp)
+    legacy_log("{}\t-> hr_meas = {} bpm".format(id, hrm_meas))
+
+
+# name, payload, before, after
+bench_list = [
+    ("hrm_meas_uint8", bytes([0x00, 72]),
+     legacy_parse_hrm_meas, ble_parser.parse_hrm_meas),
+    ("hrm_meas_uint16", bytes([0x01, 0x2c, 0x01]),
+     legacy_parse_hrm_meas, ble_parser.parse_hrm_meas),
+    ("csc_meas", bytes([0x01, 0x10, 0x27, 0x00, 0x00, 0x00, 0x04]),
+     legacy_parse_speed_csc_meas, ble_parser.parse_speed_csc_meas),
+    ("battery_level", bytes([95]),
+     legacy_parse_integer, ble_parser.parse_integer),
+    ("string", b'HRM-Pro Plus 1.2.3',
+     legacy_parse_string, ble_parser.parse_string),
+]
+
+
+def bench(func, value, number, *args):
+    timer = timeit.Timer(lambda: func("bench", value, *args))
+    return number / min(timer.repeat(repeat=3, number=number))
+
+
+def bench_legacy(number=100000):
+    result = dict()
+    for name, value, before, after in bench_list:
+        before_rate = bench(before, bytes(value), number)
+        after_rate = bench(after, bytes(value), number, 0.0)
+        result[name] = {
+            "before": before_rate,
+            "after": after_rate,
+        }
+        print("{:16s} before:{:>12.0f}/s  after:{:>12.0f}/s  x{:.2f}".format(
+            name, before_rate, after_rate, after_rate / before_rate))
+    return result
+
+
+'''
+Parsers
+
+decodes/sec of every parser in ble_parser.uuid_to_parser_dict
+'''
+
+payload_dict = {
+    UUID.CHRC_HRM_HR_MEAS: struct.pack('<BBHH', 0x16, 72, 830, 845),
+    UUID.CHRC_HRM_SNSR_LOC: bytes([1]),
+    UUID.CHRC_SNSR_LOC: bytes([12]),
+    UUID.CHRC_SPEED_CSC_MEAS: struct.pack('<BIHHH', 0x03, 10000, 1024,
+                                          500, 1024),
+    UUID.CHRC_SPEED_CSC_FEAT: bytes([0x03, 0x00]),
+    UUID.CHRC_DEVICE_SYSTEM_ID: bytes(range(8)),
+    UUID.CHRC_DEVICE_MODEL: b'HRM-Pro Plus',
+    UUID.CHRC_DEVICE_SERIAL: b'1234567890',
+    UUID.CHRC_DEVICE_FW_REV: b'1.2.3',
+    UUID.CHRC_DEVICE_HW_REV: b'A1',
+    UUID.CHRC_DEVICE_SW_REV: b'2.0',
+    UUID.CHRC_DEVICE_MANFUC: b'ACME',
+    UUID.CHRC_BATTERY_LEVEL: bytes([95]),
+}
+
+
+def bench_parsers(number=100000):
+    result = dict()
+    for uuid, parse_func in ble_parser.uuid_to_parser_dict.items():
+        value = payload_dict[uuid]
+        rate = bench(parse_func, value, number, 0.0)
+        key = UUID.uuid_to_key(uuid)
+        result[uuid] = {
+            "key": key,
+            "parser": parse_func.__name__,
+            "decodes_per_sec": rate,
+        }
+        print("{:16s} {:24s} {:>12.0f}/s".format(
+            key, parse_func.__name__, rate))
+    return result
+
+
+'''
+Pipeline
+
+everything from the recv_message_queue to the sinks, as ble_client runs
+it. latency is property_changed() enqueue -> sink, as seen by a sink
+registered after the calculators.
+'''
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 0.50),
+        "p99": percentile(samples, 0.99),
+        "max": samples[-1],
+    }
+
+
+measure_types = (ble_parser.HrmMeas, ble_parser.CscMeas)
+
+latency_list = []
+last_sample_dict = dict()  # {id: reception time of the last sample}
+
+
+def latency_sink(record):
+    if type(record) not in measure_types:
+        return
+    latency_list.append(time.monotonic() - record.timestamp)
+    last_sample_dict[record.id] = record.timestamp
+
+
+def setup_sinks():
+    # before the pipeline starts, workers inherit the sinks on fork
+    ble_parser.remove_sink(ble_parser.log_sink)
+    ble_parser.add_sink(latency_sink)
+
+
+def bench_pipeline(count=100000, rate=0.0):
+    # rate 0 floods the queue (throughput), otherwise messages/sec (latency)
+    import ble_client
+
+    hrm_path = '/bench/hrm/char0001'
+    csc_path = '/bench/csc/char0001'
+    ble_client.register_path(hrm_path, 'bench_hr_meas', UUID.CHRC_HRM_HR_MEAS)
+    ble_client.register_path(csc_path, 'bench_csc_meas',
+                             UUID.CHRC_SPEED_CSC_MEAS)
+
+    hrm_value = payload_dict[UUID.CHRC_HRM_HR_MEAS]
+    csc_value = payload_dict[UUID.CHRC_SPEED_CSC_MEAS]
+
+    del latency_list[:]
+    setup_sinks()
+    ble_client.start_pipeline()
+
+    # measure the parse path, not the overload policy
+    capacity = ble_client.recv_message_queue.capacity
+    ble_client.recv_message_queue.capacity = count
+    put = ble_client.recv_message_queue.put
+    start = time.monotonic()
+    for i in range(count >> 1):
+        if rate > 0:
+            delay = start + 2 * i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        put((hrm_path, hrm_value, time.monotonic()))
+        put((csc_path, csc_value, time.monotonic()))
+    ble_client.stop_parse_message_thread(timeout=None)
+    elapsed = time.monotonic() - start
+    ble_client.recv_message_queue.capacity = capacity
+
+    result = {
+        "rate": rate,
+        "messages": count,
+        "elapsed": elapsed,
+        "messages_per_sec": count / elapsed,
+        "latency": latency_summary(latency_list),
+    }
+    print("pipeline(rate={}): {:.0f} msg/s p50:{} p99:{}".format(
+        rate, result["messages_per_sec"], result["latency"].get("p50"),
+        result["latency"].get("p99")))
+    return result
+
+
+'''
+Bus
+
+ble_client against ble_fake_bluez.py on a private dbus-daemon: sustained
+notification rate, latency and the time from a forced disconnect to the
+first decoded sample of that device again
+'''
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(
+        ['dbus-daemon', '--session', '--nofork', '--print-address'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    return daemon, address
+
+
+def start_fake_bluez(address, args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'ble_fake_bluez.py')
+    return subprocess.Popen(
+        [sys.executable, script, '--bus', address,
+         '--adapters', str(args.adapters),
+         '--hrm', str(args.hrm), '--csc', str(args.csc),
+         '--rate', str(args.rate)] + (['--acquire'] if args.acquire else []))
+
+
+def wait_for(condition, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+
+def device_ids(ble_client, device_path):
+    prefix = device_path + '/'
+    return set(id for path, id in list(ble_client.path_id_dict.items())
+               if path.startswith(prefix))
+
+
+def all_configured(ble_client):
+    states = list(ble_client.device_state_dict.values())
+    return bool(states) and \
+        all(state == ble_client.STATE_CONFIGURED for state in states)
+
+
+def reconnect_trial(ble_client, device_path, timeout):
+    ids = device_ids(ble_client, device_path)
+    dev_object = ble_client.fetch_object(device_path)
+
+    start = time.monotonic()
+    dev_object.Disconnect(dbus_interface=ble_client.IFACE_DEVICE)
+    if not wait_for(lambda: ble_client.get_device_state(device_path) !=
+                    ble_client.STATE_CONFIGURED, timeout):
+        return None
+
+    def has_sample():
+        # received after the disconnect, not just parsed after it
+        return any(last_sample_dict.get(id, 0.0) > start for id in ids)
+
+    if not wait_for(has_sample, timeout):
+        return None
+    return time.monotonic() - start
+
+
+def bench_bus_thread(ble_client, args, result):
+    try:
+        start = time.monotonic()
+        if not wait_for(lambda: all_configured(ble_client),
+                        args.timeout):
+            result["error"] = "devices not configured in {} sec".format(
+                args.timeout)
+            return
+        result["time_to_all_configured"] = time.monotonic() - start
+
+        # let the notifications settle, then measure
+        time.sleep(1.0)
+        del latency_list[:]
+        signals = sum(ble_client.get_signal_counts().values())
+        start = time.monotonic()
+        time.sleep(args.duration)
+        elapsed = time.monotonic() - start
+        samples = list(latency_list)
+        result["notifications_per_sec"] = len(samples) / elapsed
+        result["dropped"] = ble_client.recv_message_queue.dropped()
+        result["signals_per_sec"] = (sum(
+            ble_client.get_signal_counts().values()) - signals) / elapsed
+        result["latency"] = latency_summary(samples)
+
+        reconnect = []
+        devices = sorted(ble_client.device_state_dict.keys())
+        for trial in range(args.reconnects):
+            device_path = devices[trial % len(devices)]
+            elapsed = reconnect_trial(ble_client, device_path, args.timeout)
+            print("reconnect {}: {}".format(device_path, elapsed))
+            if elapsed is not None:
+                reconnect.append(elapsed)
+            wait_for(lambda: all_configured(ble_client), args.timeout)
+        result["reconnect"] = latency_summary(reconnect)
+        result["reconnect_failed"] = args.reconnects - len(reconnect)
+        result["startup"] = dict(ble_client.get_startup_phases())
+    finally:
+        ble_client.mainloop.quit()
+
+
+def bench_bus(args):
+    import ble_client
+
+    daemon, address = start_private_bus()
+    fake = start_fake_bluez(address, args)
+    result = {
+        "adapters": args.adapters,
+        "hrm": args.hrm,
+        "csc": args.csc,
+        "rate": args.rate,
+        "acquire": args.acquire,
+        "match": args.match,
+    }
+    try:
+        ble_client.setup_mainloop(address)
+        if not wait_for(lambda: ble_client.bus.name_has_owner(
+                ble_client.BLUEZ_SERVICE_NAME), 10.0, 0.1):
+            result["error"] = "fake bluez did not start"
+            return result
+
+        del latency_list[:]
+        setup_sinks()  # start_client() starts the pipeline
+        ble_client.match_mode = args.match
+        ble_client.start_client()
+
+        t = threading.Thread(target=bench_bus_thread,
+                             args=(ble_client, args, result))
+        t.setDaemon(True)
+        t.start()
+        ble_client.mainloop.run()
+        ble_client.stop_parse_message_thread()
+    finally:
+        fake.terminate()
+        daemon.terminate()
+        fake.wait()
+        daemon.wait()
+
+    print("bus: {}".format(json.dumps(result, indent=2)))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ble_client benchmarks")
+    parser.add_argument("suites", nargs="*",
+                        default=["legacy", "parsers", "pipeline"],
+                        help="legacy, parsers, pipeline and/or bus")
+    parser.add_argument("--number", type=int, default=100000,
+                        help="iterations per parser / pipeline messages")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results as JSON to FILE")
+    parser.add_argument("--pipeline-rate", type=float, default=1000.0,
+                        help="messages/sec of the paced pipeline run")
+    parser.add_argument("--adapters", type=int, default=1)
+    parser.add_argument("--hrm", type=int, default=2)
+    parser.add_argument("--csc", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=4.0,
+                        help="notifications per second per sensor")
+    parser.add_argument("--acquire", action="store_true",
+                        help="let the fake BlueZ offer AcquireNotify")
+    parser.add_argument("--match", default="narrow",
+                        choices=["narrow", "broad"],
+                        help="D-Bus match rules of the client (bus)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="[sec] throughput measurement")
+    parser.add_argument("--reconnects", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+    }
+
+    for suite in args.suites:
+        if suite == "legacy":
+            results["legacy"] = bench_legacy(args.number)
+        elif suite == "parsers":
+            results["parsers"] = bench_parsers(args.number)
+        elif suite == "pipeline":
+            results["pipeline"] = {
+                "saturated": bench_pipeline(args.number),
+                "paced": bench_pipeline(
+                    min(args.number, int(args.pipeline_rate * 10)),
+                    args.pipeline_rate),
+            }
+        elif suite == "bus":
+            results["bus"] = bench_bus(args)
+        else:
+            print("unknown suite: {}".format(suite))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
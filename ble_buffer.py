@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import deque
+
+'''
+Bounded notification buffer
+
+one bounded FIFO per characteristic path between the D-Bus main loop
+and the parse thread. when a FIFO is full its policy decides:
+
+  drop-oldest : the oldest value goes, for streams where the latest
+                values matter most. cumulative counters (CSC revolutions)
+                survive this, the next delta just spans the gap.
+  drop-newest : the new value goes, the backlog is kept in order
+  coalesce    : only the latest value is kept (capacity 1), for
+                absolute values like the battery level
+
+messages are (path, ...) tuples; drain() hands out everything pending,
+one path after the other in the order they became pending.
+'''
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+COALESCE = "coalesce"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+CAPACITY = 256  # messages per characteristic
+
+
+class MessageBuffer(object):
+
+    def __init__(self, capacity=CAPACITY, policy=DROP_OLDEST):
+        self.capacity = capacity
+        self.policy = policy
+        self.cond = threading.Condition(threading.Lock())
+        self.fifo_dict = dict()  # {path: deque}
+        self.pending = deque()  # paths with messages, each once
+        self.policy_dict = dict()  # {path: policy}
+        self.drop_dict = dict()  # {(path, policy): messages dropped}
+        self.size = 0
+        self.stopped = False
+
+    def set_policy(self, path, policy):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy: {}".format(policy))
+        with self.cond:
+            self.policy_dict[path] = policy
+
+    def get_policy(self, path):
+        return self.policy_dict.get(path, self.policy)
+
+    def put(self, message):
+        # returns False when a message was dropped
+        path = message[0]
+        with self.cond:
+            fifo = self.fifo_dict.get(path, None)
+            if fifo is None:
+                fifo = deque()
+                self.fifo_dict[path] = fifo
+            if not fifo:
+                self.pending.append(path)
+                self.cond.notify()
+
+            policy = self.policy_dict.get(path, self.policy)
+            if policy == COALESCE:
+                capacity = 1
+            else:
+                capacity = self.capacity
+            if len(fifo) < capacity:
+                fifo.append(message)
+                self.size += 1
+                return True
+
+            key = (path, policy)
+            self.drop_dict[key] = self.drop_dict.get(key, 0) + 1
+            if policy != DROP_NEWEST:
+                fifo.popleft()
+                fifo.append(message)
+            return False
+
+    def start(self):
+        with self.cond:
+            self.stopped = False
+
+    def stop(self):
+        # wake drain(), which returns [] from now on once empty
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def drain(self):
+        # block until something is pending, then take all of it
+        with self.cond:
+            while not self.size and not self.stopped:
+                self.cond.wait()
+
+            messages = []
+            while self.pending:
+                fifo = self.fifo_dict[self.pending.popleft()]
+                messages.extend(fifo)
+                fifo.clear()
+            self.size = 0
+            return messages
+
+    def qsize(self):
+        return self.size
+
+    def dropped(self, path=None, policy=None):
+        return sum(count for (p, d), count in list(self.drop_dict.items())
+                   if (path is None or p == path) and
+                   (policy is None or d == policy))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+from collections import deque
+
+import ble_parser
+from ble_util import LOG
+
+'''
+Cycling Speed and Cadence
+
+derives speed and cadence from consecutive CSC Measurements, O(1) per
+sample
+'''
+
+WHEEL_CIRCUMFERENCE = 2.096  # [m] 700x23C
+SMOOTHING = 0.3  # weight of the newest sample in the moving average
+STOP_TIMEOUT = 3.0  # [sec] without a new event -> 0 rpm
+
+EVENT_TIME_RESOLUTION = 1024.0  # event time unit is 1/1024 sec
+EVENT_TIME_MASK = 0xFFFF
+EVENT_TIME_PERIOD = (EVENT_TIME_MASK + 1) / EVENT_TIME_RESOLUTION  # 64 sec
+
+WHEEL_REV_MASK = 0xFFFFFFFF
+CRANK_REV_MASK = 0xFFFF
+
+
+class RevCounter(object):
+    # cumulative revolution counter + last event time of one wheel/crank
+    __slots__ = ('mask', 'rev', 'event_time', 'event_timestamp',
+                 'rate', 'rate_avg')
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.rev = None
+        self.event_time = None
+        self.event_timestamp = None
+        self.rate = None
+        self.rate_avg = None
+
+    def rebase(self, rev, event_time, timestamp):
+        self.rev = rev
+        self.event_time = event_time
+        self.event_timestamp = timestamp
+
+    def update(self, rev, event_time, timestamp, smoothing, stop_timeout):
+        # returns revolutions per second, None until two events are seen
+        if self.rev is None or \
+           timestamp - self.event_timestamp >= EVENT_TIME_PERIOD:
+            # first sample, or event time may have wrapped more than once
+            if self.rev is not None:
+                self.set_rate(0.0, smoothing)
+            self.rebase(rev, event_time, timestamp)
+            return self.rate
+
+        delta_rev = (rev - self.rev) & self.mask
+        delta_tick = (event_time - self.event_time) & EVENT_TIME_MASK
+
+        if delta_rev > (self.mask >> 1):
+            # counter went backwards (sensor reset), start over
+            self.rebase(rev, event_time, timestamp)
+            return self.rate
+
+        if delta_tick == 0:
+            # no new event since the last notification
+            if timestamp - self.event_timestamp >= stop_timeout:
+                self.set_rate(0.0, smoothing)
+            return self.rate
+
+        self.set_rate(delta_rev * EVENT_TIME_RESOLUTION / delta_tick,
+                      smoothing)
+        self.rebase(rev, event_time, timestamp)
+        return self.rate
+
+    def set_rate(self, rate, smoothing):
+        self.rate = rate
+        if self.rate_avg is None:
+            self.rate_avg = rate
+        else:
+            self.rate_avg += smoothing * (rate - self.rate_avg)
+
+
+class CscCalculator(object):
+    __slots__ = ('id', 'wheel_circumference', 'smoothing', 'stop_timeout',
+                 'wheel', 'crank')
+
+    def __init__(self, id, wheel_circumference=WHEEL_CIRCUMFERENCE,
+                 smoothing=SMOOTHING, stop_timeout=STOP_TIMEOUT):
+        self.id = id
+        self.wheel_circumference = wheel_circumference
+        self.smoothing = smoothing
+        self.stop_timeout = stop_timeout
+        self.wheel = RevCounter(WHEEL_REV_MASK)
+        self.crank = RevCounter(CRANK_REV_MASK)
+
+    def update(self, record):
+        timestamp = record.timestamp
+        wheel = self.wheel
+        crank = self.crank
+
+        if record.wheel_rev is not None:
+            wheel.update(record.wheel_rev, record.wheel_time, timestamp,
+                         self.smoothing, self.stop_timeout)
+        if record.crank_rev is not None:
+            crank.update(record.crank_rev, record.crank_time, timestamp,
+                         self.smoothing, self.stop_timeout)
+
+        if wheel.rate is None:
+            speed = speed_avg = None
+        else:
+            speed = wheel.rate * self.wheel_circumference
+            speed_avg = wheel.rate_avg * self.wheel_circumference
+
+        if crank.rate is None:
+            cadence = cadence_avg = None
+        else:
+            cadence = crank.rate * 60.0
+            cadence_avg = crank.rate_avg * 60.0
+
+        return ble_parser.new_record(
+            ble_parser.CscSpeed,
+            (self.id, timestamp, speed, speed_avg, cadence, cadence_avg))
+
+
+csc_calculator_dict = dict()  # {id: CscCalculator}
+wheel_circumference_dict = dict()  # {id: circumference [m]}
+
+
+def set_wheel_circumference(id, circumference):
+    wheel_circumference_dict[id] = circumference
+    calculator = csc_calculator_dict.get(id, None)
+    if calculator is not None:
+        calculator.wheel_circumference = circumference
+
+
+def get_csc_calculator(id):
+    calculator = csc_calculator_dict.get(id, None)
+    if calculator is None:
+        circumference = wheel_circumference_dict.get(id, WHEEL_CIRCUMFERENCE)
+        LOG.info("new csc calculator %s circumference=%s", id, circumference)
+        calculator = CscCalculator(id, circumference)
+        csc_calculator_dict[id] = calculator
+    return calculator
+
+
+def csc_sink(record):
+    if type(record) is not ble_parser.CscMeas:
+        return
+
+    speed = get_csc_calculator(record.id).update(record)
+    if speed.speed is None and speed.cadence is None:
+        return
+    ble_parser.emit(speed)
+
+
+'''
+Heart Rate Variability
+
+rolling RMSSD / SDNN / pNN50 over the last HRV_WINDOW RR intervals.
+RR intervals stay in integer 1/1024 sec ticks so the running sums are
+exact and each beat only adds the new and removes the oldest term.
+'''
+
+HRV_WINDOW = 60  # RR intervals
+HRV_MIN_COUNT = 3
+
+RR_RESOLUTION = 1024.0  # RR unit is 1/1024 sec
+RR_MIN = 256  # 250 ms, 240 bpm
+RR_MAX = 2048  # 2000 ms, 30 bpm
+NN50_TICKS = 50 * 1024  # 50 ms in 1/1024 sec ticks x 1000
+
+
+class HrvCalculator(object):
+    __slots__ = ('id', 'window', 'rr_deque', 'diff_deque',
+                 'rr_sum', 'rr_sum_sq', 'diff_sum_sq', 'nn50_count')
+
+    def __init__(self, id, window=HRV_WINDOW):
+        self.id = id
+        self.window = window
+        self.rr_deque = deque()
+        self.diff_deque = deque()
+        self.rr_sum = 0
+        self.rr_sum_sq = 0
+        self.diff_sum_sq = 0
+        self.nn50_count = 0
+
+    def add_rr(self, rr):
+        rr_deque = self.rr_deque
+        diff_deque = self.diff_deque
+
+        if rr_deque:
+            diff = rr - rr_deque[-1]
+            diff_deque.append(diff)
+            self.diff_sum_sq += diff * diff
+            if abs(diff) * 1000 > NN50_TICKS:
+                self.nn50_count += 1
+
+        rr_deque.append(rr)
+        self.rr_sum += rr
+        self.rr_sum_sq += rr * rr
+
+        if len(rr_deque) > self.window:
+            old = rr_deque.popleft()
+            self.rr_sum -= old
+            self.rr_sum_sq -= old * old
+
+            diff = diff_deque.popleft()
+            self.diff_sum_sq -= diff * diff
+            if abs(diff) * 1000 > NN50_TICKS:
+                self.nn50_count -= 1
+
+    def reset(self):
+        self.rr_deque.clear()
+        self.diff_deque.clear()
+        self.rr_sum = 0
+        self.rr_sum_sq = 0
+        self.diff_sum_sq = 0
+        self.nn50_count = 0
+
+    def update(self, record):
+        for rr in record.rr:
+            if RR_MIN <= rr <= RR_MAX:
+                self.add_rr(rr)
+
+        count = len(self.rr_deque)
+        if count < HRV_MIN_COUNT:
+            return ble_parser.new_record(
+                ble_parser.HrvStat,
+                (self.id, record.timestamp, count, None, None, None))
+
+        diff_count = len(self.diff_deque)
+        rmssd = (self.diff_sum_sq / diff_count) ** 0.5
+        variance = (self.rr_sum_sq - self.rr_sum * self.rr_sum / count) / \
+            (count - 1)
+        sdnn = max(variance, 0.0) ** 0.5
+        pnn50 = 100.0 * self.nn50_count / diff_count
+
+        scale = 1000.0 / RR_RESOLUTION  # ticks -> ms
+        return ble_parser.new_record(
+            ble_parser.HrvStat,
+            (self.id, record.timestamp, count,
+             rmssd * scale, sdnn * scale, pnn50))
+
+
+hrv_calculator_dict = dict()  # {id: HrvCalculator}
+
+
+def get_hrv_calculator(id):
+    calculator = hrv_calculator_dict.get(id, None)
+    if calculator is None:
+        LOG.info("new hrv calculator %s", id)
+        calculator = HrvCalculator(id)
+        hrv_calculator_dict[id] = calculator
+    return calculator
+
+
+def hrv_sink(record):
+    if type(record) is not ble_parser.HrmMeas:
+        return
+
+    if record.contact is False:
+        # strap is off, the intervals around this gap are not beat to beat
+        calculator = hrv_calculator_dict.get(record.id, None)
+        if calculator is not None:
+            calculator.reset()
+        return
+
+    if not record.rr:
+        return
+
+    ble_parser.emit(get_hrv_calculator(record.id).update(record))
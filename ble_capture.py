@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import struct
+import time
+
+from ble_util import LOG
+
+'''
+Binary capture file
+
+  header : MAGIC
+  frame  : <BH type, body length> body
+
+  FRAME_PATH body : <H index> path '\0' uuid '\0' id
+  FRAME_DATA body : <Hd index, monotonic timestamp> payload
+
+a FRAME_PATH is written the first time a path shows up in a file, data
+frames refer to it by index. rotated files are <filename>.0001, ...
+and each one starts with its own path frames.
+'''
+
+MAGIC = b'BLECAP\x00\x01'
+
+FRAME_PATH = 0
+FRAME_DATA = 1
+
+FMT_FRAME = struct.Struct('<BH')
+FMT_PATH = struct.Struct('<H')
+FMT_DATA = struct.Struct('<Hd')
+
+BUFFER_SIZE = 64 * 1024  # [byte] write when the buffer grows beyond this
+FLUSH_INTERVAL = 1.0  # [sec] or when the last flush is older than this
+MAX_BYTES = 64 * 1024 * 1024  # [byte] rotate the file beyond this
+
+
+def rotate_filename(filename, index):
+    if index == 0:
+        return filename
+    return "{}.{:04d}".format(filename, index)
+
+
+def capture_files(filename):
+    # the capture and its rotations, in recording order
+    files = []
+    index = 0
+    while os.path.exists(rotate_filename(filename, index)):
+        files.append(rotate_filename(filename, index))
+        index += 1
+    return files
+
+
+def remove_rotations(filename):
+    # rotations of an earlier recording would be replayed after this one
+    pattern = glob.escape(filename) + '.' + '[0-9]' * 4
+    for rotation in sorted(glob.glob(pattern)):
+        LOG.info("remove old capture %s", rotation)
+        os.remove(rotation)
+
+
+class CaptureWriter(object):
+
+    def __init__(self, filename, max_bytes=MAX_BYTES,
+                 buffer_size=BUFFER_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self.index_dict = dict()  # {path: index} of every path seen
+        self.written = set()  # indexes with a FRAME_PATH in this file
+        self.path_frame_list = []  # FRAME_PATH bytes by index
+
+        self.buffer = bytearray()
+        self.flush_time = time.monotonic()
+        self.file = None
+        self.file_index = 0
+        self.file_bytes = 0
+        remove_rotations(filename)
+        self.open(0)
+
+    def open(self, file_index):
+        filename = rotate_filename(self.filename, file_index)
+        LOG.info("capture to %s", filename)
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.file_index = file_index
+        self.file_bytes = len(MAGIC)
+        self.written = set()
+
+    def rotate(self):
+        self.file.close()
+        self.open(self.file_index + 1)
+
+    def path_index(self, path, uuid, id):
+        index = self.index_dict.get(path, None)
+        if index is None:
+            index = len(self.path_frame_list)
+            body = FMT_PATH.pack(index) + '\0'.join(
+                [str(path), str(uuid), str(id)]).encode('utf-8')
+            self.path_frame_list.append(
+                FMT_FRAME.pack(FRAME_PATH, len(body)) + body)
+            self.index_dict[path] = index
+
+        if index not in self.written:
+            self.buffer += self.path_frame_list[index]
+            self.written.add(index)
+        return index
+
+    def write(self, path, uuid, id, timestamp, value):
+        if self.file_bytes >= self.max_bytes:
+            self.flush()
+            self.rotate()
+
+        index = self.path_index(path, uuid, id)
+
+        buffer = self.buffer
+        buffer += FMT_FRAME.pack(FRAME_DATA, FMT_DATA.size + len(value))
+        buffer += FMT_DATA.pack(index, timestamp)
+        buffer += bytes(value)
+
+        if len(buffer) >= self.buffer_size or \
+           time.monotonic() - self.flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flush_time = time.monotonic()
+        if not self.buffer:
+            return
+
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.file_bytes += len(self.buffer)
+        del self.buffer[:]
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+def read_frames(filename):
+    # yields (path, uuid, id, timestamp, payload) of every data frame
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a capture file: {}".format(filename))
+
+    path_dict = dict()  # {index: (path, uuid, id)}
+    offset = len(MAGIC)
+    end = len(data)
+    view = memoryview(data)
+    while offset + FMT_FRAME.size <= end:
+        frame_type, size = FMT_FRAME.unpack_from(data, offset)
+        offset += FMT_FRAME.size
+        if offset + size > end:
+            LOG.warning("truncated frame at %s in %s", offset, filename)
+            return
+
+        if frame_type == FRAME_DATA:
+            index, timestamp = FMT_DATA.unpack_from(data, offset)
+            path, uuid, id = path_dict[index]
+            yield path, uuid, id, timestamp, \
+                bytes(view[offset + FMT_DATA.size:offset + size])
+        elif frame_type == FRAME_PATH:
+            index = FMT_PATH.unpack_from(data, offset)[0]
+            fields = bytes(view[offset + FMT_PATH.size:offset + size])
+            path, uuid, id = fields.decode('utf-8').split('\0')
+            if id == 'None':
+                id = None
+            path_dict[index] = (path, uuid, id)
+        else:
+            LOG.warning("unknown frame type %s in %s", frame_type, filename)
+
+        offset += size
+
+
+def read_capture(filename):
+    for capture_file in capture_files(filename):
+        for frame in read_frames(capture_file):
+            yield frame
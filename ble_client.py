@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 __version__ = "1.0.0"
 
+import sys
 import threading
 import dbus
+import dbus.lowlevel
 try:
     from gi.repository import GObject
 except ImportError:
     import gobject as GObject
-import os
 import time
+import random
 import signal
+import socket
+import struct
 import json
-import queue
+import logging
+import argparse
 
 import ble_uuid as UUID
 
-from ble_util import LOG
+from ble_util import LOG, install_log_level_signals
 import ble_parser
+import ble_calc
+import ble_objtree
+import ble_capture
+import ble_metrics
+import ble_buffer
+import ble_gattcache
+import ble_ring
+import ble_table
 
 from dbus.mainloop.glib import DBusGMainLoop
 
@@ -24,9 +37,13 @@ from dbus.mainloop.glib import DBusGMainLoop
 bus = None
 mainloop = None
 
-recv_message_queue = queue.Queue()
+startup_time = time.monotonic()  # module import, close to process start
+
+recv_message_queue = ble_buffer.MessageBuffer()
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
+DBUS_SERVICE_NAME = 'org.freedesktop.DBus'
+DBUS_OBJECT_PATH = '/org/freedesktop/DBus'
 
 IFACE_DBUS_OM = 'org.freedesktop.DBus.ObjectManager'
 IFACE_DBUS_PROP = 'org.freedesktop.DBus.Properties'
@@ -36,11 +53,19 @@ IFACE_DEVICE = 'org.bluez.Device1'
 IFACE_GATT_SERVICE = 'org.bluez.GattService1'
 IFACE_GATT_CHRC = 'org.bluez.GattCharacteristic1'
 
-PATH_ADAPTER = '/org/bluez/hci0'
+# interfaces narrow match rules are added for
+WATCHED_IFACES = frozenset((IFACE_ADAPTER, IFACE_DEVICE, IFACE_GATT_CHRC))
 
 
 def interfaces_removed_cb(object_path, interfaces):
-    LOG.debug("{}: {}".format(object_path, interfaces))
+    LOG.debug("%s: %s", object_path, interfaces)
+    ble_objtree.remove_interfaces(object_path, interfaces)
+    # e.g. Battery1 goes on disconnect, the device and its rules stay
+    if ble_objtree.has_object(object_path) and \
+       not WATCHED_IFACES.intersection(str(iface) for iface in interfaces):
+        return
+    unwatch_path(object_path)
+    proxy_dict.pop(object_path, None)
 
 
 '''
@@ -48,39 +73,62 @@ BlueZ Management
 '''
 
 
+proxy_dict = dict()  # {path: proxy}, introspected once
+
+
 def fetch_object(path):
+    proxy = proxy_dict.get(path, None)
+    if proxy is not None:
+        return proxy
     try:
-        return bus.get_object(BLUEZ_SERVICE_NAME, path)
+        proxy = bus.get_object(BLUEZ_SERVICE_NAME, path)
+        proxy_dict[path] = proxy
+        return proxy
     except Exception as e:
-        LOG.error("faital error in fetch_object({}): {}".format(path, str(e)))
-        mainloop.quit()
+        LOG.error("faital error in fetch_object(%s): %s", path, str(e))
+        quit_mainloop(1)
 
 
-def fetch_property(path, iface):
-    try:
-        obj = fetch_object(path)
-        obj_props = obj.GetAll(iface, dbus_interface=IFACE_DBUS_PROP)
-    except Exception as e:
-        LOG.error("failed fetch_property: {}".format(e))
-        obj_props = None
+def dbus_call_metrics(method):
+    return (ble_metrics.histogram("ble_dbus_call_seconds",
+                                  "blocking D-Bus call time", method=method),
+            ble_metrics.counter("ble_dbus_call_errors",
+                                "failed blocking D-Bus calls", method=method))
 
-    return obj_props
+
+getall_metrics = dbus_call_metrics("GetAll")
+get_managed_objects_metrics = dbus_call_metrics("GetManagedObjects")
+fetch_property_cached = ble_metrics.counter(
+    "ble_fetch_property_cached", "fetch_property answered by the mirror")
 
 
-def reset_bluetooth_power():
-    adapter = bus.get_object(BLUEZ_SERVICE_NAME, PATH_ADAPTER)
-    adapter_props = dbus.Interface(adapter, IFACE_DBUS_PROP)
+def fetch_property(path, iface, cached=True):
+    # answer from the local object tree, GetAll only for unknown objects
+    if cached:
+        obj_props = ble_objtree.get_properties(path, iface)
+        if obj_props is not None:
+            fetch_property_cached.inc()
+            return obj_props
 
     try:
-        adapter_props.Set(IFACE_ADAPTER, "Powered", dbus.Boolean(0))
-        LOG.info("power off")
-        time.sleep(3)
-        adapter_props.Set(IFACE_ADAPTER, "Powered", dbus.Boolean(1))
-        LOG.info("power on")
-        time.sleep(3)
+        with ble_metrics.Timer(getall_metrics[0]):
+            obj = fetch_object(path)
+            obj_props = obj.GetAll(iface, dbus_interface=IFACE_DBUS_PROP)
     except Exception as e:
-        LOG.error("can't reset power state:{}".format(repr(e)))
-        exit()
+        getall_metrics[1].inc()
+        LOG.error("failed fetch_property: %s", e)
+        return None
+
+    ble_objtree.add_interfaces(path, {iface: obj_props})
+    return obj_props
+
+
+def connect_bus(address):
+    if address == 'system':
+        return dbus.SystemBus()
+    if address == 'session':
+        return dbus.SessionBus()
+    return dbus.bus.BusConnection(address)
 
 
 def get_object_manager():
@@ -90,86 +138,433 @@ def get_object_manager():
 
 def get_managed_objects():
     try:
-        om = get_object_manager()
-        objects = om.GetManagedObjects()
+        with ble_metrics.Timer(get_managed_objects_metrics[0]):
+            om = get_object_manager()
+            objects = om.GetManagedObjects()
         return objects
     except Exception as e:
-        LOG.error("faital error in get_managed_objects(): {}".format(str(e)))
-        mainloop.quit()
+        get_managed_objects_metrics[1].inc()
+        LOG.error("faital error in get_managed_objects(): %s", str(e))
+        quit_mainloop(1)
 
 
 def fetch_child_objs(root_path, iface):
+    return ble_objtree.get_children(root_path, iface)
+
+
+def seed_object_tree():
     objects = get_managed_objects()
-    paths = []
+    if objects is None:
+        return False
 
-    for path, interfaces in objects.items():
-        if iface not in interfaces.keys():
-            continue
-        dir_path = os.path.dirname(path)  # to get device path
-        if dir_path != root_path:
-            continue
+    ble_objtree.seed(objects)
+    return True
 
-        obj_props = fetch_property(path, iface)
-        if not obj_props:
-            return []
 
-        uuid = obj_props['UUID']
-        paths.append([path, uuid])
+def read_value_cb(path, value):
+    value = bytes(value)
+    LOG.debug("READ: %s -> %s", path, value)
+    # read values go through the parse pipeline like notifications
+    submit(path, value, time.monotonic())
 
-    return paths
+    uuid = path_uuid_dict.get(path, None)
+    if ble_gattcache.is_static(uuid):
+        cache_static_value(path, uuid, value)
 
 
-def read_value_cb(value):
-    value_str = ''.join([chr(byte) for byte in value])
-    value_str = value_str.encode('utf-8')
-    value_array = [int(byte) for byte in value]
-    LOG.debug("READ: -> {} : {}".format(value_str, value_array))
+'''
+Startup phases
 
+seconds from startup_time to the first time each phase is reached,
+ending with the first decoded notification
+'''
 
-read_error_flg = False
+startup_phase_dict = dict()  # {phase: sec since startup_time}
+first_notification = True
 
 
-def read_value_error_cb(error):
-    LOG.error("read value error: {}".format(error))
-    global read_error_flg
-    read_error_flg = True
+def mark_phase(phase, elapsed=None):
+    # elapsed is given when the phase was reached in a worker
+    if phase in startup_phase_dict:
+        return
+    if elapsed is None:
+        elapsed = time.monotonic() - startup_time
+    startup_phase_dict[phase] = elapsed
+    LOG.info("startup %s: %.3f sec", phase, elapsed)
 
 
-def parse_message_thread():
-    global path_id_dict
-    global recv_message_queue
+def get_startup_phases():
+    return sorted(startup_phase_dict.items(), key=lambda item: item[1])
 
-    ch = 5
+
+parse_thread = None
+
+'''
+Metrics
+
+the objects are looked up once and kept; recording is an attribute
+update. per characteristic counters are created on the first value.
+parser time and parse latency are timed for 1 in METRICS_SAMPLE_MASK + 1
+messages, which keeps the clock reads and histogram updates off most of
+the parse path.
+'''
+
+METRICS_SAMPLE_MASK = 0xf
+
+queue_depth_gauge = ble_metrics.gauge(
+    "ble_recv_queue_depth", "messages waiting for the parse thread",
+    func=lambda: recv_message_queue.qsize())
+batch_size_histogram = ble_metrics.histogram(
+    "ble_parse_batch_size", "messages taken from the queue at once",
+    buckets=ble_metrics.SIZE_BUCKETS)
+parse_latency_histogram = ble_metrics.histogram(
+    "ble_parse_latency_seconds", "reception to parser completion")
+malformed_counter = ble_metrics.counter(
+    "ble_malformed_values", "values the parser rejected")
+unknown_counter = ble_metrics.counter(
+    "ble_unknown_values", "values without a parser")
+
+recv_counter_dict = dict()  # {path: Counter}, main loop only
+parser_histogram_dict = dict()  # {parse_func: Histogram}
+parse_count = 0
+
+
+def recv_counter(path):
+    counter = recv_counter_dict.get(path, None)
+    if counter is None:
+        counter = ble_metrics.counter(
+            "ble_notifications", "values received per characteristic",
+            id=path_id_dict.get(path, path))
+        recv_counter_dict[path] = counter
+    return counter
+
+
+def parser_histogram(parse_func):
+    histogram = parser_histogram_dict.get(parse_func, None)
+    if histogram is None:
+        histogram = ble_metrics.histogram(
+            "ble_parser_seconds", "time spent in a ble_parser function",
+            parser=parse_func.__name__)
+        parser_histogram_dict[parse_func] = histogram
+    return histogram
+
+
+parse_latency = {
+    "count": 0,
+    "last": 0.0,
+    "max": 0.0,
+    "total": 0.0,
+}
+
+
+def update_parse_latency(latency):
+    global parse_latency
+
+    parse_latency["count"] += 1
+    parse_latency["last"] = latency
+    parse_latency["total"] += latency
+    if latency > parse_latency["max"]:
+        parse_latency["max"] = latency
+
+
+def get_parse_latency():
+    # end-to-end latency from property_changed() to parser completion [sec]
+    count = parse_latency["count"]
+    avg = parse_latency["total"] / count if count else 0.0
+    return {
+        "count": count,
+        "last": parse_latency["last"],
+        "max": parse_latency["max"],
+        "avg": avg,
+    }
+
+
+capture_writer = None  # ble_capture.CaptureWriter while recording
+
+
+def parse_message(path, value, recv_time, timestamp=None):
+    # timestamp is the original reception time when replaying a capture
+    if timestamp is None:
+        timestamp = recv_time
+
+    slot = dispatch_table.get(path, None)
+    if slot is None:
+        unknown_counter.inc()
+        LOG.warning("Unknown path in dispatch table: %s", path)
+        return
+
+    if capture_writer is not None:
+        capture_writer.write(path, slot.uuid, slot.id, timestamp, value)
+
+    global parse_count
+    parse_count += 1
+    start = None if parse_count & METRICS_SAMPLE_MASK else time.perf_counter()
+    try:
+        record = slot.parse_func(slot.id, value, timestamp)
+    except (struct.error, IndexError, ValueError) as e:
+        slot.malformed += 1
+        malformed_counter.inc()
+        LOG.warning("malformed value %s %s: %s", slot.id, path, e)
+        return
+    slot.count += 1
+    if start is not None:
+        slot.histogram.observe(time.perf_counter() - start)
+
+    ble_parser.emit(record)
+    latency = time.monotonic() - recv_time
+    update_parse_latency(latency)
+    if start is not None:
+        parse_latency_histogram.observe(latency)
+
+    global first_notification
+    if first_notification:
+        first_notification = False
+        mark_phase("first notification")
+
+
+def parse_message_thread():
     LOG.info("start thread")
     while True:
-        if not recv_message_queue.empty():
-            path, value = recv_message_queue.get()
+        # block until a message arrives, then take everything pending
+        messages = recv_message_queue.drain()
+        if not messages:
+            LOG.info("stop thread")
+            return
+        LOG.debug("drain %s messages", len(messages))
+        batch_size_histogram.observe(len(messages))
 
-            LOG.debug("{} {}".format(path, value))
-            id = path_id_dict.get(path, None)
-            LOG.debug(id)
-            uuid = path_uuid_dict.get(path, None)
-            LOG.debug(uuid)
+        for message in messages:
+            parse_message(*message)
 
-            if uuid not in ble_parser.uuid_to_parser_dict:
-                LOG.warning("Unknown uuid in cb_table: {}".format(uuid))
-                return
 
-            parse_func = ble_parser.uuid_to_parser_dict[uuid]
-            parse_func(id, value)  # {id: [ payload, data_type ]}
+def start_parse_message_thread():
+    global parse_thread
 
-        else:
-            time.sleep(0.1)
+    LOG.debug("kick parse_message_thread()")
+    recv_message_queue.start()
+    parse_thread = threading.Thread(target=parse_message_thread, args=([]))
+    parse_thread.setDaemon(True)
+    parse_thread.start()
+
+
+def start_pipeline():
+    ble_parser.add_sink(ble_calc.csc_sink)
+    ble_parser.add_sink(ble_calc.hrv_sink)
+    if value_table is not None:
+        ble_parser.add_sink(value_table.sink)
+    if worker_count:
+        start_worker_pool(worker_count)
+    else:
+        start_parse_message_thread()
 
 
-def device_prop_changed(interface, changed, invalidated, path):
-    if interface != IFACE_DEVICE:
+def stop_parse_message_thread(timeout=1.0):
+    if worker_pool is not None:
+        stop_worker_pool(timeout)
+        return
+    if parse_thread is None or not parse_thread.is_alive():
         return
-    LOG.debug(path)
-    LOG.debug(changed)
+
+    # the thread parses what is still buffered, then stops
+    recv_message_queue.stop()
+    parse_thread.join(timeout)
+    LOG.info("parse latency: %s", get_parse_latency())
+    LOG.info("dropped messages: %s", recv_message_queue.dropped())
+
+    if capture_writer is not None:
+        capture_writer.close()
+
+
+def start_capture(filename, max_bytes=ble_capture.MAX_BYTES):
+    global capture_writer
+    capture_writer = ble_capture.CaptureWriter(filename, max_bytes)
+
+
+'''
+Worker processes
+
+with worker_count > 0 values are decoded in forked worker processes
+instead of the parse thread, each fed by a ble_ring shared-memory ring.
+the main loop only copies the bytes of a value into the ring of the
+device's worker; parsers and sinks run in the worker. a full ring drops
+the new value.
+
+the parse metrics are recorded in the workers. each one publishes them
+in its ring, the main loop adds them up into its own metric objects
+every WORKER_METRICS_INTERVAL, which stay 0 otherwise in this mode.
+'''
+
+WORKER_METRICS_INTERVAL = 1  # [sec]
+
+worker_count = 0
+worker_pool = None  # ble_ring.WorkerPool, None in a worker
+worker_counters = []  # [Counter] carried back from the workers
+worker_histograms = []  # [Histogram] carried back from the workers
+
+
+def worker_metrics_size():
+    # counters, then counts and sum per histogram, then first notification
+    return len(worker_counters) + \
+        sum(len(histogram.counts) + 1 for histogram in worker_histograms) + 1
+
+
+def collect_worker_metrics():
+    # runs in a worker
+    values = [float(counter.value) for counter in worker_counters]
+    for histogram in worker_histograms:
+        values.extend(histogram.counts)
+        values.append(histogram.sum)
+    values.append(startup_phase_dict.get("first notification", -1.0))
+    return values
+
+
+def update_worker_metrics():
+    # runs in the main loop, the sums of every worker
+    totals = None
+    first = []
+    for values in worker_pool.metrics():
+        if totals is None:
+            totals = list(values)
+        else:
+            totals = [total + value for total, value in zip(totals, values)]
+        if values[-1] >= 0:
+            first.append(values[-1])
+
+    i = 0
+    for counter in worker_counters:
+        counter.value = int(totals[i])
+        i += 1
+    for histogram in worker_histograms:
+        size = len(histogram.counts)
+        histogram.counts = [int(count) for count in totals[i:i + size]]
+        histogram.sum = totals[i + size]
+        i += size + 1
+    if first:
+        mark_phase("first notification", min(first))
+
+
+def worker_metrics_cb():
+    if worker_pool is None:
+        return False
+    update_worker_metrics()
+    return True
+
+
+def submit(path, value, recv_time):
+    # hand a received value to the decoder
+    if worker_pool is not None:
+        worker_pool.put(path, bytes(value), recv_time)
+    else:
+        recv_message_queue.put((path, value, recv_time))
+
+
+def worker_init():
+    # runs in a new worker: decode here, never forward to a pool
+    global worker_pool
+    worker_pool = None
+    # the lock may have been held by the metrics server thread at fork
+    ble_metrics.lock = threading.Lock()
+
+
+def start_worker_pool(workers):
+    global worker_pool
+
+    global worker_counters, worker_histograms
+    worker_counters = [malformed_counter, unknown_counter]
+    parse_funcs = set(ble_parser.uuid_to_parser_dict.values())
+    worker_histograms = [parse_latency_histogram] + [
+        parser_histogram(parse_func)
+        for parse_func in sorted(parse_funcs, key=lambda f: f.__name__)]
+
+    pool = ble_ring.WorkerPool(workers, parse_message, register_path,
+                               worker_init, collect_worker_metrics,
+                               worker_metrics_size())
+    # paths registered before the pool existed
+    for path, id in list(path_id_dict.items()):
+        pool.register(path, id, path_uuid_dict[path])
+    pool.start()
+
+    for number, ring in enumerate(pool.rings):
+        ble_metrics.gauge(
+            "ble_worker_backlog_bytes", "bytes waiting in a worker ring",
+            func=lambda ring=ring: ring.stats()["backlog"], worker=number)
+        ble_metrics.counter(
+            "ble_worker_frames", "values decoded by a worker",
+            func=lambda ring=ring: ring.stats()["frames"], worker=number)
+        ble_metrics.counter(
+            "ble_worker_dropped", "values dropped on a full worker ring",
+            func=lambda ring=ring: ring.stats()["dropped"], worker=number)
+    worker_pool = pool
+    GObject.timeout_add(WORKER_METRICS_INTERVAL * 1000, worker_metrics_cb)
+
+
+def worker_latency(stats):
+    # like get_parse_latency(), over every worker
+    count = sum(stat["frames"] for stat in stats)
+    total = sum(stat["latency_total"] for stat in stats)
+    return {
+        "count": count,
+        "max": max([stat["latency_max"] for stat in stats] or [0.0]),
+        "avg": total / count if count else 0.0,
+    }
+
+
+def stop_worker_pool(timeout=1.0):
+    global worker_pool
+
+    pool = worker_pool
+    pool.stop(timeout)
+    update_worker_metrics()
+    worker_pool = None
+    stats = pool.stats()
+    LOG.info("worker latency: %s", worker_latency(stats))
+    LOG.info("dropped messages: %s", sum(stat["dropped"] for stat in stats))
+
+
+'''
+Replay
+'''
+
+
+def replay_capture(filename, speed=1.0):
+    # feed a capture through the parse pipeline, speed 0 is as fast as
+    # possible, otherwise a multiple of real time
+    start = time.monotonic()
+    first = None
+    count = 0
+    for path, uuid, id, timestamp, payload in ble_capture.read_capture(
+            filename):
+        if first is None:
+            first = timestamp
+
+        if speed > 0:
+            delay = start + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if path not in dispatch_table:
+            register_path(path, id, uuid)
+            add_table_slots(id, uuid)
+        recv_message_queue.put((path, payload, time.monotonic(), timestamp))
+        count += 1
+
+    LOG.info("replayed %s frames in %.3f sec", count, time.monotonic() - start)
+    return count
+
+
+def replay_main(filename, speed):
+    # a replay is never dropped, it waits in the buffer instead
+    recv_message_queue.capacity = float('inf')
+    start_pipeline()
+
+    replay_capture(filename, speed)
+
+    stop_parse_message_thread(timeout=None)
 
 
 def property_changed(interface, changed, invalidated, path):
+    ble_objtree.update_properties(path, interface, changed, invalidated)
+
     if interface != IFACE_GATT_CHRC:
         return
 
@@ -180,14 +575,15 @@ def property_changed(interface, changed, invalidated, path):
     value = changed.get('Value', None)
 
     if notify:
-        LOG.info("{} Notifying = {}".format(path, notify))
+        LOG.info("%s Notifying = %s", path, notify)
         return
 
     if not value:
         LOG.warning("value is None")
         return
 
-    recv_message_queue.put((path, value))
+    recv_counter(path).inc()
+    submit(path, value, time.monotonic())
 
 
 path_id_dict = dict()
@@ -195,409 +591,1573 @@ path_uuid_dict = dict()
 
 
 def update_id_uuid_list(profile_key, chrc_key, path, uuid):
-    global path_id_dict
-    global path_uuid_dict
-
     if not profile_key:
         profile_key = "UNKNOWN"
 
     id = profile_key + '_' + chrc_key
 
-    path_id_dict[path] = id.lower()
+    register_path(path, id.lower(), uuid)
+    set_buffer_policy(path, uuid)
+    add_table_slots(id.lower(), uuid)
+
+
+'''
+Dispatch table
+
+everything the parse thread needs for a characteristic, looked up once
+per value by object path. the main loop builds the slots at
+configuration time and publishes a new table for every change, so the
+parse thread reads a table that never changes under it. a path without
+a parser gets no slot and counts as unknown.
+'''
+
+
+class Slot(object):
+    __slots__ = ('id', 'uuid', 'short', 'parse_func', 'histogram',
+                 'count', 'malformed')
+
+    def __init__(self, id, uuid, parse_func):
+        self.id = id
+        self.uuid = uuid
+        self.short = UUID.short_uuid(uuid)  # None for a 128-bit uuid
+        self.parse_func = parse_func
+        self.histogram = parser_histogram(parse_func)
+        self.count = 0  # values parsed, parse thread only
+        self.malformed = 0
+
+
+dispatch_table = dict()  # {path: Slot}, replaced, never changed
+
+
+def register_path(path, id, uuid):
+    global dispatch_table
+
+    path = sys.intern(str(path))
+    uuid = str(uuid)
+    path_id_dict[path] = id
     path_uuid_dict[path] = uuid
 
+    table = dict(dispatch_table)
+    parse_func = ble_parser.get_parser(uuid)
+    if parse_func is None:
+        LOG.warning("no parser for %s %s", uuid, path)
+        table.pop(path, None)
+    else:
+        table[path] = Slot(id, uuid, parse_func)
+    dispatch_table = table
+
+    if worker_pool is not None:
+        worker_pool.register(path, id, uuid)
+
+
+def get_slot(path):
+    return dispatch_table.get(path, None)
 
-def start_notify_cb():
-    LOG.info('notifications enabled')
 
+'''
+Value table
+
+with value_table set, the latest values are also written to a
+ble_table.Table for local consumers. its slots are assigned here in the
+main loop, the decoder only writes them.
+'''
+
+value_table = None  # ble_table.Table
+
+
+def add_table_slots(id, uuid):
+    if value_table is None:
+        return
+    kinds = ble_table.PARSER_KINDS.get(ble_parser.get_parser(uuid), ())
+    for kind in kinds:
+        value_table.alloc(id, kind, UUID.short_uuid(uuid))
+
+
+'''
+Buffer policy
+
+absolute values keep only the latest one, measurement streams drop the
+oldest values when the parse thread falls behind. buffer_policy
+overrides this for every characteristic.
+'''
+
+COALESCE_PARSERS = (ble_parser.parse_integer, ble_parser.parse_integer_signed,
+                    ble_parser.parse_string, ble_parser.parse_binary)
+
+buffer_policy = None  # one of ble_buffer.POLICIES, None: per parser
+
+
+def set_buffer_policy(path, uuid):
+    policy = buffer_policy
+    if policy is None:
+        parse_func = ble_parser.get_parser(uuid)
+        if parse_func in COALESCE_PARSERS:
+            policy = ble_buffer.COALESCE
+        else:
+            policy = ble_buffer.DROP_OLDEST
+    recv_message_queue.set_policy(path, policy)
 
-def start_notify_error_cb(error):
-    LOG.error('D-Bus call failed: ' + str(error))
+    ble_metrics.counter(
+        "ble_buffer_dropped", "values dropped or coalesced when the "
+        "characteristic buffer is full",
+        func=lambda: recv_message_queue.dropped(path),
+        id=path_id_dict.get(path, path), policy=policy)
 
 
-def configure_chrc(service_path, profile_key):
+def call_done(done, error=None):
+    # done(error) completes one operation of a configuration job
+    if done is not None:
+        done(error)
+
+
+def start_notify_cb(path, done):
+    LOG.info("notifications enabled: %s", path)
+    call_done(done)
+
+
+def start_notify_error_cb(path, done, error):
+    LOG.error("StartNotify failed %s: %s", path, error)
+    call_done(done, error)
+
+
+def start_notify(path, chrc_key, done=None):
+    LOG.info("start notify key=%s", chrc_key)
+    watch_chrc(path)  # the match rule goes to the bus before StartNotify
+    chrc_obj = fetch_object(path)
+    chrc_obj.StartNotify(
+        reply_handler=lambda: start_notify_cb(path, done),
+        error_handler=lambda e: start_notify_error_cb(path, done, e),
+        dbus_interface=IFACE_GATT_CHRC)
+
+
+'''
+AcquireNotify
+
+notifications are read as raw packets from the socket handed out by
+BlueZ instead of PropertiesChanged signals
+'''
+
+notify_sock_dict = dict()  # {chrc_path: [sock, buffer, watch_id]}
+
+
+def notify_sock_cb(fd, condition, path):
+    entry = notify_sock_dict.get(path, None)
+    if entry is None:
+        return False
+
+    sock, buf, watch_id = entry
+    view = memoryview(buf)
+    while True:
+        try:
+            size = sock.recv_into(buf)
+        except BlockingIOError:
+            break
+        except OSError as e:
+            LOG.warning("notify socket error %s: %s", path, e)
+            release_notify(path)
+            return False
+
+        if size == 0:
+            break
+
+        recv_counter(path).inc()
+        submit(path, bytes(view[:size]), time.monotonic())
+
+    if condition & (GObject.IO_HUP | GObject.IO_ERR):
+        LOG.info("notify socket closed: %s", path)
+        release_notify(path)
+        return False
+
+    return True
+
+
+def release_notify(path):
+    entry = notify_sock_dict.pop(path, None)
+    if entry is None:
+        return
+
+    sock, buf, watch_id = entry
+    GObject.source_remove(watch_id)
+    sock.close()
+
+
+def acquire_notify_cb(path, fd, mtu, done=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET,
+                         fileno=fd.take())
+    sock.setblocking(False)
+
+    release_notify(path)
+    watch_id = GObject.io_add_watch(
+        sock.fileno(), GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+        notify_sock_cb, path)
+    notify_sock_dict[path] = [sock, bytearray(int(mtu)), watch_id]
+    LOG.info("notify acquired: %s mtu=%s", path, mtu)
+    call_done(done)
+
+
+def acquire_notify_error_cb(path, chrc_key, error, done=None):
+    LOG.warning("AcquireNotify failed %s: %s", path, error)
+    start_notify(path, chrc_key, done)
+
+
+def acquire_notify(path, chrc_key, done=None):
+    LOG.info("acquire notify key=%s", chrc_key)
+    chrc_obj = fetch_object(path)
+    chrc_obj.AcquireNotify(
+        dbus.Dictionary({}, signature='sv'),
+        reply_handler=lambda fd, mtu: acquire_notify_cb(path, fd, mtu, done),
+        error_handler=lambda e: acquire_notify_error_cb(path, chrc_key, e,
+                                                        done),
+        dbus_interface=IFACE_GATT_CHRC)
+
+
+def read_value_error_cb(path, done, error):
+    LOG.error("read value error %s: %s", path, error)
+    call_done(done, error)
+
+
+def read_chrc(path, done=None):
+    def reply(value):
+        read_value_cb(path, value)
+        call_done(done)
+
+    fetch_object(path).ReadValue(
+        {}, reply_handler=reply,
+        error_handler=lambda e: read_value_error_cb(path, done, e),
+        dbus_interface=IFACE_GATT_CHRC)
+
+
+def configure_one_chrc(job, path, uuid, flags, profile_key, read=True):
+    device_path = job.device_path
+    chrc_key = UUID.uuid_to_key(uuid)
+    LOG.info("============")
+    LOG.info("%s %s %s", uuid, chrc_key, path)
+    update_id_uuid_list(profile_key, chrc_key, path, uuid)
+    chrc_device_dict[path] = device_path
+    LOG.info("Flag: %s", flags)
+
+    if 'read' in flags and read:
+        job_run(job, OP_READ, path, read_chrc)
+    if 'notify' in flags or 'indicate' in flags:
+        if path in notify_sock_dict:
+            return
+        props = fetch_property(path, IFACE_GATT_CHRC)
+        # NotifyAcquired is only exposed when AcquireNotify works
+        if 'NotifyAcquired' in props and not props['NotifyAcquired']:
+            job_run(job, OP_NOTIFY, path,
+                    lambda p, done: acquire_notify(p, chrc_key, done))
+        elif props.get('Notifying', 0) == 0:
+            job_run(job, OP_NOTIFY, path,
+                    lambda p, done: start_notify(p, chrc_key, done))
+
+
+def configure_chrc(job, service_path, profile_key, layout):
+    # layout collects [path below the device, uuid, flags] for the cache
     LOG.info("====================")
-    LOG.info("arg={}".format(service_path))
+    LOG.info("arg=%s", service_path)
 
     chrcs = fetch_child_objs(service_path, IFACE_GATT_CHRC)
 
     for path, uuid in chrcs:
-        chrc_key = UUID.uuid_to_key(uuid)
-        LOG.debug("{} {} {}".format(uuid, chrc_key, path))
-        if chrc_key:
-            LOG.info("============")
-            LOG.info("{} {} {}".format(uuid, chrc_key, path))
-            update_id_uuid_list(profile_key, chrc_key, path, uuid)
+        LOG.debug("%s %s", uuid, path)
+        if UUID.uuid_to_key(uuid):
             props = fetch_property(path, IFACE_GATT_CHRC)
-            flags = props.get('Flags', {})
-            for flag in flags:
-                LOG.info("Flag: {}".format(flags))
-                if flag == 'read':
-                    chrc_obj = fetch_object(path)
-                    chrc_obj.ReadValue({}, reply_handler=read_value_cb,
-                                       error_handler=read_value_error_cb,
-                                       dbus_interface=IFACE_GATT_CHRC)
-                if flag == 'notify' or flag == 'indicate':
-                    notify = props['Notifying']
-                    if notify == 0:
-                        LOG.info("start notify key={}".format(chrc_key))
-                        chrc_obj = fetch_object(path)
-                        chrc_obj.StartNotify(reply_handler=start_notify_cb,
-                                             error_handler=start_notify_error_cb,
-                                             dbus_interface=IFACE_GATT_CHRC)
-
-    global path_id_dict
-    global path_uuid_dict
-    LOG.debug(json.dumps(path_id_dict, indent=2))
-    LOG.debug(json.dumps(path_uuid_dict, indent=2))
-
-
-def configure_service(device_path, profile_key):
+            flags = props.get('Flags', [])
+            configure_one_chrc(job, path, uuid, flags, profile_key)
+            layout.append([path[len(job.device_path) + 1:], uuid, flags])
+
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug(json.dumps(path_id_dict, indent=2))
+        LOG.debug(json.dumps(path_uuid_dict, indent=2))
+
+
+'''
+GATT cache
+
+a device configured before is set up from ble_gattcache: no service
+walk, and static values come from the cache instead of ReadValue. only
+the firmware revision is read; the cached values are held back until it
+matches. a new firmware drops the entry and the services are walked
+again, the layout may have changed too.
+'''
+
+CACHE_SAVE_DELAY = 2  # [sec] coalesce cache writes
+
+chrc_device_dict = dict()  # {chrc_path: device_path}
+cached_value_dict = dict()  # {device_path: [(chrc_path, value)]} unverified
+cache_save_id = None
+
+
+def cache_save_cb():
+    global cache_save_id
+    cache_save_id = None
+    ble_gattcache.save()
+    return False
+
+
+def schedule_cache_save():
+    global cache_save_id
+    if cache_save_id is None and ble_gattcache.enabled():
+        cache_save_id = GObject.timeout_add(CACHE_SAVE_DELAY * 1000,
+                                            cache_save_cb)
+
+
+def cache_static_value(path, uuid, value):
+    device_path = chrc_device_dict.get(path, None)
+    address = device_address_dict.get(device_path, None)
+    if address is None:
+        return
+
+    relpath = path[len(device_path) + 1:]
+    if uuid == UUID.CHRC_DEVICE_FW_REV:
+        if not ble_gattcache.check_fw_rev(address, value):
+            # new firmware, the layout may have changed as well
+            drop_cache(device_path)
+            rewalk_device(device_path)
+            return
+        # same firmware, the values held back are valid
+        for chrc_path, cached_value in cached_value_dict.pop(device_path,
+                                                             []):
+            submit(chrc_path, cached_value, time.monotonic())
+
+    ble_gattcache.set_value(address, relpath, value)
+    schedule_cache_save()
+
+
+def drop_cache(device_path):
+    cached_value_dict.pop(device_path, None)
+    ble_gattcache.remove(device_address_dict.get(device_path, None))
+    schedule_cache_save()
+
+
+def rewalk_device(device_path):
+    job = config_job_dict.get(device_path, None)
+    if job is not None:
+        job.rewalk = True  # once the current operations are done
+    elif get_device_state(device_path) == STATE_CONFIGURED:
+        set_device_state(device_path, STATE_RESOLVED)
+
+
+def cached_layout(device_path, entry):
+    # None unless every cached characteristic is still there
+    layout = []
+    for relpath, uuid, flags in entry["chrcs"]:
+        path = device_path + '/' + relpath
+        props = ble_objtree.get_properties(path, IFACE_GATT_CHRC)
+        if props is None or str(props.get('UUID', '')) != uuid:
+            return None
+        layout.append([path, relpath, uuid, flags])
+    return layout
+
+
+def configure_from_cache(job, profile_key):
+    device_path = job.device_path
+    address = device_address_dict.get(device_path, None)
+    entry = ble_gattcache.get(address)
+    if entry is None:
+        return False
+
+    layout = cached_layout(device_path, entry)
+    if not layout:
+        LOG.info("gatt cache of %s is stale", address)
+        ble_gattcache.remove(address)
+        return False
+
+    LOG.info("configure %s from gatt cache", device_path)
+    cached_values = []
+    has_fw_rev = False
+    for path, relpath, uuid, flags in layout:
+        value = None
+        if uuid == UUID.CHRC_DEVICE_FW_REV:
+            has_fw_rev = True
+        elif ble_gattcache.is_static(uuid):
+            value = ble_gattcache.get_value(address, relpath)
+        configure_one_chrc(job, path, uuid, flags, profile_key,
+                           read=value is None)
+        if value is not None:
+            cached_values.append((path, value))
+
+    if has_fw_rev:
+        # submitted once the firmware revision read matches the cache
+        cached_value_dict[device_path] = cached_values
+    else:
+        for path, value in cached_values:
+            submit(path, value, time.monotonic())
+    return True
+
+
+def configure_service(job, profile_key):
+    device_path = job.device_path
     LOG.info("**********************************************")
-    LOG.debug("args=({}, {})".format(device_path, profile_key))
+    LOG.debug("args=(%s, %s)", device_path, profile_key)
+
+    if configure_from_cache(job, profile_key):
+        return True
 
     services = fetch_child_objs(device_path, IFACE_GATT_SERVICE)
 
     count_service = 0
+    layout = []
     for path, uuid in services:
         service_key = UUID.uuid_to_key(uuid)
-        LOG.debug("service: {} {} ".format(uuid, path))
+        LOG.debug("service: %s %s ", uuid, path)
 
         if service_key:
             count_service += 1
-            LOG.info("detect service:{} {} {}".format(uuid, service_key, path))
-            configure_chrc(path, profile_key)
-
-    LOG.info("count_service:{}".format(count_service))
+            LOG.info("detect service:%s %s %s", uuid, service_key, path)
+            configure_chrc(job, path, profile_key, layout)
 
-    global read_error_flg
-    if read_error_flg:
-        read_error_flg = False
-        LOG.warning("can't configure service {}".format(profile_key))
-        return False
+    LOG.info("count_service:%s", count_service)
 
     if count_service == 0:
-        LOG.warning("can't detect service {} in {}".format(profile_key, device_path))
+        LOG.warning("can't detect service %s in %s", profile_key, device_path)
         return False
 
+    address = device_address_dict.get(device_path, None)
+    if address is not None:
+        ble_gattcache.put(address, layout)
+        schedule_cache_save()
     return True
 
 
-def service_thread(device_path, profile_key):
-    LOG.info("*********** enter to loop")
-    is_configured_service = False
-    while True:
-        time.sleep(3)
+'''
+Configuration jobs
 
-        if not is_connected_device(device_path):
-            LOG.info("not connected {}".format(profile_key))
-            is_configured_service = False
-            continue
+every read and notify enable of a device is issued at once; the job is
+the barrier that completes when the last of them replied. a failed
+operation is retried on its own, CHRC_RETRY times. a device whose reads
+failed is still configured, one whose notify enable failed is
+configured again later. jobs of other devices are not affected.
+'''
 
-        is_resolved = is_service_resolved(device_path)
-        LOG.debug("service resolved {}: {}".format(device_path, is_resolved))
+OP_READ = "read"
+OP_NOTIFY = "notify"
+CHRC_RETRY = 3
+CHRC_RETRY_DELAY = 1.0  # [sec] x attempt
 
-        if (not is_resolved):
-            LOG.info("service is not resolved, waiting...")
-            continue
+config_job_dict = dict()  # {device_path: ConfigJob} in progress
+configure_histogram = ble_metrics.histogram(
+    "ble_configure_seconds", "device configuration, first to last reply")
 
-        if not is_configured_service:
-            LOG.debug("configure_service({} {})".format(device_path, profile_key))
-            if configure_service(device_path, profile_key):
-                is_configured_service = True
-                LOG.info("configured service success: {}".format(device_path))
 
+class ConfigJob(object):
+    __slots__ = ('device_path', 'start', 'issuing', 'pending',
+                 'retry_dict', 'failed', 'rewalk')
 
-'''
-Device Interface
-'''
+    def __init__(self, device_path):
+        self.device_path = device_path
+        self.start = time.monotonic()
+        self.issuing = True  # operations are still being issued
+        self.pending = set()  # (op, path) without a reply yet
+        self.retry_dict = dict()  # {(op, path): retries}
+        self.failed = set()  # (op, path) out of retries
+        self.rewalk = False  # the gatt cache was stale, walk the services
 
 
-def is_connected_device(device_path):
-    dev_props = fetch_property(device_path, IFACE_DEVICE)
+def job_alive(job):
+    return config_job_dict.get(job.device_path, None) is job
 
-    if dev_props is None:
-        return False
 
-    is_connected = dev_props.get("Connected", 0)
-    if is_connected == 1:
-        return True
+def job_run(job, op, path, func):
+    # func(path, done) starts the operation, done(error) ends it
+    key = (op, path)
+    job.pending.add(key)
+    func(path, lambda error: job_done(job, key, func, error))
+
+
+def job_retry_cb(job, key, func):
+    if job_alive(job):
+        func(key[1], lambda error: job_done(job, key, func, error))
     return False
 
 
-def is_alive_device(device_path):
-    dev_props = fetch_property(device_path, IFACE_DEVICE)
+def job_done(job, key, func, error):
+    if not job_alive(job):
+        return  # the device went away, a new job starts over
+
+    if error is not None:
+        retry = job.retry_dict.get(key, 0) + 1
+        job.retry_dict[key] = retry
+        if retry <= CHRC_RETRY:
+            LOG.warning("retry %s %s (%s/%s)", key[0], key[1], retry,
+                        CHRC_RETRY)
+            GObject.timeout_add(int(CHRC_RETRY_DELAY * retry * 1000),
+                                job_retry_cb, job, key, func)
+            return
+        job.failed.add(key)
+
+    job.pending.discard(key)
+    if not job.pending and not job.issuing:
+        job_finish(job)
+
+
+def job_finish(job):
+    device_path = job.device_path
+    del config_job_dict[device_path]
+    elapsed = time.monotonic() - job.start
+    configure_histogram.observe(elapsed)
+    ble_metrics.gauge("ble_device_configure_seconds",
+                      "last configuration time of a device",
+                      id=device_key_dict[device_path]).set(elapsed)
+
+    for op, path in sorted(job.failed):
+        LOG.error("%s %s failed", op, path)
+    LOG.info("configured %s in %.3f sec, %s operations failed",
+             device_path, elapsed, len(job.failed))
+
+    if device_path in cached_value_dict:
+        # the firmware revision was never read, don't trust the cache
+        LOG.warning("can't verify gatt cache of %s", device_path)
+        drop_cache(device_path)
+        job.rewalk = True
+    if job.rewalk:
+        # still RESOLVED, the entry is gone: a full service walk
+        GObject.idle_add(configure_device_cb, device_path)
+        return
 
-    if dev_props is None:
+    if any(op == OP_NOTIFY for op, path in job.failed):
+        GObject.timeout_add(CONFIGURE_RETRY_INTERVAL * 1000,
+                            configure_device_cb, device_path)
+        return
+    set_device_state(device_path, STATE_CONFIGURED)
+
+
+def configure_device_cb(device_path):
+    if get_device_state(device_path) != STATE_RESOLVED:
+        return False
+    if device_path in config_job_dict:
         return False
 
-    rssi = dev_props.get("RSSI", None)
-    if rssi:
-        LOG.info("RSSI={} {}".format(rssi, device_path))
-        return True
-    else:
-        LOG.warning("no RSSI {}".format(device_path))
+    profile_key = device_key_dict[device_path]
+    job = ConfigJob(device_path)
+    config_job_dict[device_path] = job
+    LOG.debug("configure_service(%s %s)", device_path, profile_key)
+    if not configure_service(job, profile_key):
+        del config_job_dict[device_path]
+        # retry later unless the device goes away in the meantime
+        GObject.timeout_add(CONFIGURE_RETRY_INTERVAL * 1000,
+                            configure_device_cb, device_path)
         return False
+
+    job.issuing = False
+    if not job.pending:
+        job_finish(job)
     return False
 
 
-def is_service_resolved(device_path):
-    dev_props = fetch_property(device_path, IFACE_DEVICE)
+'''
+Device State
+'''
+
+STATE_DISCONNECTED = "disconnected"
+STATE_DISCOVERED = "discovered"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_RESOLVED = "services-resolved"
+STATE_CONFIGURED = "configured"
+
+WATCHDOG_INTERVAL = 30
+CONFIGURE_RETRY_INTERVAL = 3
+
+device_state_dict = dict()  # {device_path: state}
+
+
+def get_device_state(device_path):
+    return device_state_dict.get(device_path, STATE_DISCONNECTED)
+
+
+def set_device_state(device_path, state):
+    # only called from the main loop
+    old_state = device_state_dict.get(device_path, None)
+    if old_state == state:
+        return
+    device_state_dict[device_path] = state
+    LOG.info("%s: %s -> %s", device_path, old_state, state)
+
+    if old_state == STATE_CONNECTING:
+        connect_finished(device_path, state)
+    if state not in (STATE_RESOLVED, STATE_CONFIGURED):
+        config_job_dict.pop(device_path, None)
+        cached_value_dict.pop(device_path, None)
+    if state in (STATE_CONNECTED, STATE_CONFIGURED):
+        mark_phase("first {}".format(state))
+
+    if state == STATE_RESOLVED:
+        GObject.idle_add(configure_device_cb, device_path)
+    schedule_connect()
+
+
+def device_state_from_props(dev_props, state):
+    if not dev_props.get("Connected", False):
+        if state == STATE_CONNECTING:
+            return state
+        if dev_props.get("RSSI", None) is not None:
+            return STATE_DISCOVERED
+        return STATE_DISCONNECTED
+
+    if not dev_props.get("ServicesResolved", False):
+        return STATE_CONNECTED
+
+    if state == STATE_CONFIGURED:
+        return state
+    return STATE_RESOLVED
+
+
+def update_device_state(device_path, dev_props):
     if dev_props is None:
-        return False
+        set_device_state(device_path, STATE_DISCONNECTED)
+        return
+
+    state = get_device_state(device_path)
+    set_device_state(device_path, device_state_from_props(dev_props, state))
+
+
+def sync_device_state(device_path):
+    update_device_state(device_path,
+                        ble_objtree.get_properties(device_path, IFACE_DEVICE))
 
-    is_resolved = dev_props.get("Connected", 0)
-    if is_resolved == 1:
-        return True
-    return False
 
+def device_prop_changed(interface, changed, invalidated, path):
+    if interface != IFACE_DEVICE:
+        return
+    if path not in device_state_dict:
+        return
+    LOG.debug("%s %s", path, changed)
 
-is_connecting = False
+    state = get_device_state(path)
 
+    connected = changed.get("Connected", None)
+    resolved = changed.get("ServicesResolved", None)
 
-def device_connect_cb():
-    LOG.info("connection successful")
+    if connected is not None and not connected:
+        set_device_state(path, STATE_DISCONNECTED)
+        return
 
-    global is_connecting
-    is_connecting = False
+    if resolved is not None:
+        if resolved:
+            if state != STATE_CONFIGURED:
+                set_device_state(path, STATE_RESOLVED)
+        elif state in (STATE_RESOLVED, STATE_CONFIGURED):
+            set_device_state(path, STATE_CONNECTED)
+        return
 
+    if connected:
+        if state in (STATE_DISCONNECTED, STATE_DISCOVERED, STATE_CONNECTING):
+            set_device_state(path, STATE_CONNECTED)
+        return
 
-def device_connect_error_cb(error):
-    LOG.warning('device_connect_error_cb(error): ' + str(error))
-    time.sleep(1)
-    global is_connecting
-    is_connecting = False
+    if "RSSI" in changed and state == STATE_DISCONNECTED:
+        set_device_state(path, STATE_DISCOVERED)
 
 
-def device_connect(device_path, key):
-    # Connect Device if no connected
-    dev_object = fetch_object(device_path)
-    dev_iface = dbus.Interface(dev_object, IFACE_DEVICE)
+'''
+Device Interface
+'''
+
+
+def is_connected_device(device_path):
+    return get_device_state(device_path) in (STATE_CONNECTED,
+                                             STATE_RESOLVED,
+                                             STATE_CONFIGURED)
+
+
+'''
+Connection attempts
+
+connects run in parallel, at most connect_concurrency per adapter. each
+attempt has its own timeout, a failed device waits an exponential
+backoff with jitter before the next one, and devices with the strongest
+recent RSSI go first.
+'''
+
+CONNECT_CONCURRENCY = 2  # connects in flight per adapter
+CONNECT_TIMEOUT = 15  # [sec]
+BACKOFF_BASE = 2.0  # [sec] after the first failure
+BACKOFF_MAX = 60.0  # [sec]
+RSSI_UNKNOWN = -127  # [dBm] sorts devices without RSSI last
+
+connect_concurrency = CONNECT_CONCURRENCY
+connect_timer_dict = dict()  # {device_path: timeout source id}
+backoff_dict = dict()  # {device_path: [failures, not before (monotonic)]}
+backoff_timer_id = None
+
+
+def backoff_delay(failures):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (failures - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def connect_finished(device_path, state):
+    timer_id = connect_timer_dict.pop(device_path, None)
+    if timer_id is not None:
+        GObject.source_remove(timer_id)
+
+    if state in (STATE_CONNECTED, STATE_RESOLVED, STATE_CONFIGURED):
+        backoff_dict.pop(device_path, None)
+        return
+
+    failures = backoff_dict.get(device_path, [0, 0.0])[0] + 1
+    delay = backoff_delay(failures)
+    backoff_dict[device_path] = [failures, time.monotonic() + delay]
+    LOG.info("backoff %s %.1f sec after %s failures",
+             device_path, delay, failures)
+
+
+def in_backoff(device_path, now):
+    backoff = backoff_dict.get(device_path, None)
+    return backoff is not None and backoff[1] > now
+
+
+def schedule_backoff(now):
+    # one timer for the earliest backoff expiry
+    global backoff_timer_id
+    if backoff_timer_id is not None:
+        return
+
+    waits = [backoff[1] - now for backoff in backoff_dict.values()
+             if backoff[1] > now]
+    if not waits:
+        return
+    backoff_timer_id = GObject.timeout_add(int(min(waits) * 1000) + 1,
+                                           backoff_timer_cb)
+
+
+def backoff_timer_cb():
+    global backoff_timer_id
+    backoff_timer_id = None
+    schedule_connect()
+    return False
+
+
+def device_rssi(device_path):
+    dev_props = ble_objtree.get_properties(device_path, IFACE_DEVICE)
+    if not dev_props:
+        return RSSI_UNKNOWN
+    return int(dev_props.get("RSSI", RSSI_UNKNOWN))
 
-    global is_connecting
 
-    if is_connected_device(device_path):
-        LOG.info("already connected: {}".format(device_path))
+def connect_failed(device_path):
+    # DISCOVERED while the device is still seen, the backoff timer
+    # connects it again then
+    dev_props = ble_objtree.get_properties(device_path, IFACE_DEVICE)
+    if dev_props is None:
+        set_device_state(device_path, STATE_DISCONNECTED)
+        return
+    set_device_state(device_path,
+                     device_state_from_props(dev_props, STATE_DISCONNECTED))
+
+
+def connect_timeout_cb(device_path):
+    connect_timer_dict.pop(device_path, None)
+    if get_device_state(device_path) != STATE_CONNECTING:
         return False
 
-    LOG.info("not connected, Try to connect:{}".format(device_path))
+    LOG.warning("connect timeout %s", device_path)
+    # Disconnect also cancels a pending Connect in BlueZ
+    fetch_object(device_path).Disconnect(
+        reply_handler=lambda: None,
+        error_handler=lambda e: LOG.debug("cancel connect %s: %s",
+                                          device_path, e),
+        dbus_interface=IFACE_DEVICE)
+    connect_failed(device_path)
+    return False
+
+
+def device_connect_cb(device_path):
+    LOG.info("connection successful: %s", device_path)
+
+
+def device_connect_error_cb(device_path, error):
+    LOG.warning("device_connect_error_cb(%s): %s", device_path, error)
+    if get_device_state(device_path) == STATE_CONNECTING:
+        connect_failed(device_path)
+
+
+def device_connect(device_path, key):
+    LOG.info("not connected, Try to connect:%s %s", key, device_path)
+    set_device_state(device_path, STATE_CONNECTING)
     try:
-        is_connecting = True
-        dev_iface.Connect(reply_handler=device_connect_cb,
-                          error_handler=device_connect_error_cb,
-                          dbus_interface=IFACE_DEVICE)
+        dev_object = fetch_object(device_path)
+        dev_object.Connect(
+            reply_handler=lambda: device_connect_cb(device_path),
+            error_handler=lambda e: device_connect_error_cb(device_path, e),
+            dbus_interface=IFACE_DEVICE,
+            timeout=CONNECT_TIMEOUT + 5)
     except Exception as e:
-        LOG.error("connection error {}, {}".format(device_path, e))
-        time.sleep(1)
-        is_connecting = False
+        LOG.error("connection error %s, %s", device_path, e)
+        connect_failed(device_path)
         return False
-    count = 0
-    while(is_connecting):
-        LOG.info("connecting....{}".format(device_path))
-        count += 1
-        if count > 15:
-            LOG.error("connection timeout (faital error)")
-            return False
-        time.sleep(2)
-    LOG.info("connection success: {}".format(key))
-    if is_connected_device(device_path):
-        return wait_services_resolved(device_path)
 
+    connect_timer_dict[device_path] = GObject.timeout_add(
+        CONNECT_TIMEOUT * 1000, connect_timeout_cb, device_path)
+    return True
+
+
+def connect_devices():
+    now = time.monotonic()
+    connecting_dict = dict((path, 0) for path in adapter_list)
+    candidates = []
+    for address, dev_path in list(connection_table.items()):
+        state = get_device_state(dev_path)
+        if state == STATE_CONNECTING:
+            connecting_dict[adapter_of(dev_path)] += 1
+        elif state == STATE_DISCOVERED and not in_backoff(dev_path, now):
+            candidates.append(dev_path)
+
+    # strongest signal first
+    candidates.sort(key=device_rssi, reverse=True)
+    for dev_path in candidates:
+        adapter_path = adapter_of(dev_path)
+        if connecting_dict[adapter_path] >= connect_concurrency:
+            continue
+        if device_connect(dev_path, device_key_dict[dev_path]):
+            connecting_dict[adapter_path] += 1
+
+    schedule_backoff(now)
+
+
+'''
+Watchdog / Discovery
+'''
+
+
+def watchdog_reply_cb(device_path, dev_props):
+    ble_objtree.add_interfaces(device_path, {IFACE_DEVICE: dev_props})
+    update_device_state(device_path, dev_props)
+
+
+def watchdog_error_cb(device_path, error):
+    LOG.warning("watchdog GetAll %s: %s", device_path, error)
+    update_device_state(device_path, None)
+
+
+def refresh_device(device_path):
+    fetch_object(device_path).GetAll(
+        IFACE_DEVICE, dbus_interface=IFACE_DBUS_PROP,
+        reply_handler=lambda props: watchdog_reply_cb(device_path, props),
+        error_handler=lambda e: watchdog_error_cb(device_path, e))
+
+
+def device_watchdog():
+    # fallback for lost signals: re-read Device1 from BlueZ
+    LOG.debug("watchdog")
+    for address, path in list(connection_table.items()):
+        refresh_device(path)
+    LOG.info("signals delivered: %s", signal_count_dict)
+    schedule_connect()
+    return True
+
+
+'''
+Discovery
+
+scanning is limited to LE advertisers of the supported services above
+an RSSI floor. an adapter with missing devices scans SCAN_WINDOW sec at
+a duty cycle that follows the share of its devices still missing:
+continuous while half or more are missing, down to SCAN_DUTY_MIN.
+'''
+
+DISCOVERY_RSSI = -90  # [dBm] ignore weaker advertisers
+SCAN_WINDOW = 10  # [sec] scan time of one cycle
+SCAN_DUTY_MIN = 0.1
+
+discovery_rssi = DISCOVERY_RSSI
+discovery_pending = set()  # adapter paths with a Start/StopDiscovery call
+scan_dict = dict()  # {adapter_path: [duty, pause until, timer id]}
+
+
+def discovery_filter():
+    return {
+        "Transport": dbus.String("le"),
+        "UUIDs": dbus.Array([uuid for profile, uuid in profile_uuid_list],
+                            signature='s'),
+        "RSSI": dbus.Int16(discovery_rssi),
+    }
+
+
+def set_discovery_filter(adapter_path):
+    fetch_object(adapter_path).SetDiscoveryFilter(
+        discovery_filter(),
+        reply_handler=lambda: LOG.info("discovery filter %s", adapter_path),
+        error_handler=lambda e: LOG.warning("SetDiscoveryFilter %s: %s",
+                                            adapter_path, e),
+        dbus_interface=IFACE_ADAPTER)
+
+
+def discovery_cb(adapter_path, method):
+    discovery_pending.discard(adapter_path)
+    LOG.info("%s SCAN %s ***************", method, adapter_path)
+    schedule_connect()  # in case the wanted state changed meanwhile
+
+
+def discovery_error_cb(adapter_path, method, error):
+    discovery_pending.discard(adapter_path)
+    LOG.warning("Scan error %s %s: %s", method, adapter_path, error)
+
+
+def set_discovery(adapter_path, scan):
+    if adapter_path in discovery_pending:
+        return
+
+    adapter_props = fetch_property(adapter_path, IFACE_ADAPTER)
+    if adapter_props is None:
+        return
+    discovering = adapter_props.get('Discovering', False)
+
+    if scan and not discovering:
+        method = 'StartDiscovery'
+    elif not scan and discovering:
+        method = 'StopDiscovery'
+    else:
+        return
+
+    discovery_pending.add(adapter_path)
+    adapter_obj = fetch_object(adapter_path)
+    getattr(adapter_obj, method)(
+        reply_handler=lambda: discovery_cb(adapter_path, method),
+        error_handler=lambda e: discovery_error_cb(adapter_path, method, e),
+        dbus_interface=IFACE_ADAPTER)
+
+
+def scan_duty(missing, total):
+    if not missing:
+        return 0.0
+    return min(1.0, max(SCAN_DUTY_MIN, 2.0 * missing / total))
+
+
+def scan_window_cb(adapter_path):
+    # end of a scan window: pause for the rest of the cycle
+    scan = scan_dict[adapter_path]
+    duty = scan[0]
+    if 0.0 < duty < 1.0:
+        pause = SCAN_WINDOW * (1.0 - duty) / duty
+        scan[1] = time.monotonic() + pause
+        scan[2] = GObject.timeout_add(int(pause * 1000), scan_pause_cb,
+                                      adapter_path)
+        LOG.debug("scan pause %s %.1f sec", adapter_path, pause)
+    else:
+        scan[2] = None
+    schedule_connect()
     return False
 
 
-def wait_services_resolved(device_path):
-    # to wait services resolved
-    count = 0
-    while(True):
-        is_resolved = is_service_resolved(device_path)
-        LOG.debug("service resolved {}: {}".format(device_path, is_resolved))
+def scan_pause_cb(adapter_path):
+    # the timer fires up to a millisecond before the end of the pause
+    scan = scan_dict[adapter_path]
+    scan[1] = 0.0
+    scan[2] = None
+    schedule_connect()
+    return False
 
-        if (is_resolved):
-            LOG.info("Service resolved! :{}".format(device_path))
-            return True
 
-        if(is_connected_device(device_path) is False):
-            LOG.error("Waiting service resolved, but disconnected")
-            return False
-        LOG.info("waiting service resolved...")
-        count += 1
+def update_discovery(adapter_path, missing, total):
+    now = time.monotonic()
+    scan = scan_dict.setdefault(adapter_path, [0.0, 0.0, None])
+    duty = scan_duty(missing, total)
+    if duty > scan[0] and scan[1] > now:
+        # a device went missing, cut the pause short
+        scan[1] = 0.0
+        if scan[2] is not None:
+            GObject.source_remove(scan[2])
+            scan[2] = None
+    scan[0] = duty
 
-        if count > 30:
-            LOG.warning("wait service timeout")
-            return False
+    scan_now = duty > 0.0 and scan[1] <= now
+    if scan_now and duty < 1.0 and scan[2] is None:
+        scan[2] = GObject.timeout_add(SCAN_WINDOW * 1000, scan_window_cb,
+                                      adapter_path)
+    set_discovery(adapter_path, scan_now)
 
-        time.sleep(1)
 
+'''
+Scheduler
 
+every device lifecycle runs on the GLib main loop: PropertiesChanged
+moves the device state, a state change queues the work it enables with
+idle_add, and retries and the watchdog are timers. D-Bus calls made
+from here are asynchronous.
 '''
-Thread
+
+connect_pass_pending = False
+watchdog_id = None
+
+
+def schedule_connect():
+    # many state changes in one main loop iteration -> one connect pass
+    global connect_pass_pending
+    if connect_pass_pending:
+        return
+    connect_pass_pending = True
+    GObject.idle_add(connect_pass_cb)
+
+
+def connect_pass_cb():
+    global connect_pass_pending
+    connect_pass_pending = False
+
+    missing_dict = dict((path, 0) for path in adapter_list)
+    for address, dev_path in list(connection_table.items()):
+        if get_device_state(dev_path) in (STATE_DISCONNECTED,
+                                          STATE_DISCOVERED):
+            missing_dict[adapter_of(dev_path)] += 1
+
+    for adapter_path, missing in missing_dict.items():
+        update_discovery(adapter_path, missing,
+                         adapter_load_dict.get(adapter_path, 0))
+
+    connect_devices()
+    return False
+
+
+def start_scheduler():
+    global watchdog_id
+    if watchdog_id is None:
+        for adapter_path in adapter_list:
+            set_discovery_filter(adapter_path)
+        watchdog_id = GObject.timeout_add(WATCHDOG_INTERVAL * 1000,
+                                          device_watchdog)
+    schedule_connect()
+
+
 '''
+Adapter / Device assignment
 
+devices are keyed by address. a device seen by several adapters is
+given to the one with the fewest devices that is still below
+adapter_max_connections.
+'''
 
-def check_connection_state(connection_table):
+ADAPTER_MAX_CONNECTIONS = 7
 
-    result = True
-    for key, path in connection_table.items():
-        if is_connected_device(path) is False:
-            result = False
-            break
+adapter_max_connections = ADAPTER_MAX_CONNECTIONS
+adapter_list = []  # adapter paths in use
+adapter_load_dict = dict()  # {adapter_path: number of assigned devices}
 
-    return result
+connection_table = dict()  # {address: device_path}
+device_address_dict = dict()  # {device_path: address}
+device_key_dict = dict()  # {device_path: id namespace, e.g. hrm_aa_bb_..}
 
+profile_uuid_list = [
+    ["HRM", UUID.SERVICE_HRM],
+    ["SPEED", UUID.SERVICE_SPEED],
+]
 
-def device_connect_thread(connection_table):
 
-    adapter = fetch_object(PATH_ADAPTER)
-    adapter_if = dbus.Interface(adapter, IFACE_ADAPTER)
+def adapter_of(device_path):
+    return device_path.rsplit('/', 1)[0]
 
-    while True:
-        if check_connection_state(connection_table):
-            LOG.info("all device is connected")
-            adapter_props = fetch_property(PATH_ADAPTER, IFACE_ADAPTER)
-            discovering = adapter_props.get('Discovering', False)
 
-            if discovering:
-                adapter_if.StopDiscovery()
-                LOG.info("stop SCAN ***************")
+def select_adapters(names=None):
+    global adapter_list
 
-            time.sleep(5)
-            continue
+    paths = sorted(ble_objtree.get_paths(IFACE_ADAPTER))
+    if names:
+        paths = [path for path in paths if path.rsplit('/', 1)[1] in names]
 
-        # Scan devices
-        adapter_props = fetch_property(PATH_ADAPTER, IFACE_ADAPTER)
-        discovering = adapter_props.get('Discovering', False)
+    adapter_list = paths
+    for path in paths:
+        adapter_load_dict.setdefault(path, 0)
+    LOG.info("adapters: %s", adapter_list)
+    return adapter_list
 
-        if not discovering:
-            try:
-                adapter_if.StartDiscovery()
-                LOG.info("start SCAN ***************")
-            except Exception as e:
-                LOG.warning("Scan error: {}".format(str(e)))
 
-        # Connect device if device is alive
-        for profile_key, dev_path in connection_table.items():
+def device_key(profile_key, address):
+    return "{}_{}".format(profile_key, address.replace(':', '_')).lower()
 
-            if is_connected_device(dev_path) is True:
-                LOG.info("already connected {}".format(dev_path))
-                continue
 
-            if not is_alive_device(dev_path):
-                LOG.info("can't find device near side: {}".format(dev_path))
+def assign_devices():
+    # returns the device paths newly added to connection_table
+    candidate_dict = dict()  # {address: [device_path, ...]}
+    profile_dict = dict()  # {address: profile_key}
+    for profile_key, uuid in profile_uuid_list:
+        for device_path in ble_objtree.find_by_uuid(uuid, IFACE_DEVICE):
+            if adapter_of(device_path) not in adapter_load_dict:
                 continue
+            props = ble_objtree.get_properties(device_path, IFACE_DEVICE)
+            address = str(props.get('Address', device_path))
+            if address in connection_table:
+                continue
+            candidate_dict.setdefault(address, []).append(device_path)
+            profile_dict.setdefault(address, profile_key)
+
+    assigned = []
+    # devices with the fewest adapters to choose from go first
+    for address in sorted(candidate_dict,
+                          key=lambda a: (len(candidate_dict[a]), a)):
+        paths = [path for path in candidate_dict[address]
+                 if adapter_load_dict[adapter_of(path)] <
+                 adapter_max_connections]
+        if not paths:
+            LOG.warning("no adapter left for %s", address)
+            continue
 
-            LOG.info("start connect {}".format(dev_path))
-            device_connect(dev_path, profile_key)
+        device_path = min(paths,
+                          key=lambda p: adapter_load_dict[adapter_of(p)])
+        adapter_load_dict[adapter_of(device_path)] += 1
+        connection_table[address] = device_path
+        device_address_dict[device_path] = address
+        device_key_dict[device_path] = device_key(profile_dict[address],
+                                                  address)
+        assigned.append(device_path)
+        LOG.info("%s: %s %s", address, profile_dict[address], device_path)
 
-        time.sleep(2)
+    return assigned
+
+
+'''
+Adapter power
+
+an adapter that passes the health check is used as it is. otherwise it
+is powered off and on, each step waits for PropertiesChanged on Powered
+instead of a fixed sleep.
+'''
+
+POWER_RESET_AUTO = "auto"  # only adapters that fail the health check
+POWER_RESET_ALWAYS = "always"
+POWER_RESET_NEVER = "never"
+POWER_TIMEOUT = 10  # [sec] for one Powered transition
+
+power_wait_dict = dict()  # {adapter_path: [wanted Powered, timeout id]}
+power_ready_cb = None  # called once every adapter is powered
+
+
+def adapter_healthy(adapter_path):
+    adapter_props = ble_objtree.get_properties(adapter_path, IFACE_ADAPTER)
+    if not adapter_props or not adapter_props.get("Powered", False):
+        return False
+    # PowerState exists since BlueZ 5.66, e.g. "off-blocked" by rfkill
+    return adapter_props.get("PowerState", "on") == "on"
+
+
+def power_error_cb(adapter_path, error):
+    LOG.error("can't set power state %s: %s", adapter_path, error)
+    quit_mainloop(1)
+
+
+def power_timeout_cb(adapter_path):
+    LOG.error("%s Powered did not change in %s sec",
+              adapter_path, POWER_TIMEOUT)
+    quit_mainloop(1)
+    return False
+
+
+def set_adapter_power(adapter_path, powered):
+    LOG.info("power %s %s", "on" if powered else "off", adapter_path)
+    power_wait_dict[adapter_path] = [
+        powered,
+        GObject.timeout_add(POWER_TIMEOUT * 1000, power_timeout_cb,
+                            adapter_path)]
+    fetch_object(adapter_path).Set(
+        IFACE_ADAPTER, "Powered", dbus.Boolean(powered),
+        dbus_interface=IFACE_DBUS_PROP,
+        reply_handler=lambda: None,
+        error_handler=lambda e: power_error_cb(adapter_path, e))
+
+
+def adapter_prop_changed(interface, changed, invalidated, path):
+    if interface != IFACE_ADAPTER:
+        return
+    powered = changed.get("Powered", None)
+    wait = power_wait_dict.get(path, None)
+    if powered is None or wait is None or bool(powered) != wait[0]:
+        return
+
+    del power_wait_dict[path]
+    GObject.source_remove(wait[1])
+    if not powered:
+        set_adapter_power(path, True)
+        return
+
+    LOG.info("powered %s", path)
+    check_power_ready()
+
+
+def check_power_ready():
+    global power_ready_cb
+    if power_wait_dict or power_ready_cb is None:
+        return
+
+    callback = power_ready_cb
+    power_ready_cb = None
+    mark_phase("adapters powered")
+    callback()
+
+
+def power_up_adapters(mode, callback):
+    global power_ready_cb
+    power_ready_cb = callback
+
+    for adapter_path in adapter_list:
+        adapter_props = fetch_property(adapter_path, IFACE_ADAPTER) or {}
+        powered = bool(adapter_props.get("Powered", False))
+        if mode == POWER_RESET_NEVER or \
+           (mode == POWER_RESET_AUTO and adapter_healthy(adapter_path)):
+            if not powered:
+                LOG.warning("%s is not powered", adapter_path)
+            continue
+
+        # power off first if it is on, the off step then powers on
+        set_adapter_power(adapter_path, not powered)
+
+    check_power_ready()
+
+
+def start_device(device_path):
+    LOG.info("start device %s %s", device_key_dict[device_path], device_path)
+    sync_device_state(device_path)
+
+    # changes before the match rule was installed are only in BlueZ
+    watch_device(device_path)
+    refresh_device(device_path)
 
 
 def configure_device():
-    objects = get_managed_objects()
+    for device_path in assign_devices():
+        start_device(device_path)
 
-    all_devices = (str(path) for path, interfaces in objects.items()
-                   if IFACE_DEVICE in interfaces.keys())
-
-    connection_table = {}
-    for device_path in all_devices:
-        LOG.debug("------------")
-        LOG.debug(device_path)
-        dev = objects[device_path]
-        properties = dev[IFACE_DEVICE]
-        uuids = properties["UUIDs"]
-        for uuid in uuids:
-            LOG.debug(uuid)
-            if uuid == UUID.SERVICE_HRM:
-                connection_table["HRM"] = device_path
-            if uuid == UUID.SERVICE_SPEED:
-                connection_table["SPEED"] = device_path
-
-    LOG.info("connection_table: {}".format(connection_table))
+    LOG.info("connection_table: %s", connection_table)
+    LOG.info("adapter load: %s", adapter_load_dict)
 
     if len(connection_table) == 0:
+        # may run in a signal handler, which would swallow SystemExit
         LOG.error("No supported devices are registered")
-        time.sleep(5)
-        exit()
+        quit_mainloop(1)
+        return False
 
-    for key, path in connection_table.items():
-        LOG.info("{}:{}".format(key, path))
-
-    for profile_key, device_path in connection_table.items():
-        LOG.info("kick service_thread({},{})".format(profile_key, device_path))
-        t = threading.Thread(target=service_thread,
-                             args=(device_path, profile_key))
-        t.setDaemon(True)
-        t.start()
-
-    LOG.debug("kick device_connect_thread({})".format(connection_table))
-    t = threading.Thread(target=device_connect_thread,
-                         args=([connection_table]))
-    t.setDaemon(True)
-    t.start()
+    mark_phase("devices assigned")
+    start_scheduler()
     return True
 
 
 def interfaces_added(path, interfaces):
+    LOG.debug("%s: %s", path, list(interfaces.keys()))
+    ble_objtree.add_interfaces(path, interfaces)
+
+    if IFACE_DEVICE in interfaces and connection_table:
+        # a supported device paired or seen by another adapter at runtime
+        for device_path in assign_devices():
+            start_device(device_path)
+
+
+def setup_mainloop(address):
+    # Set up the main loop.
+    DBusGMainLoop(set_as_default=True)
+    global bus
+    bus = connect_bus(address)
+
+    global mainloop
+    GObject.threads_init()
+    mainloop = GObject.MainLoop()
+    mark_phase("bus connected")
+
+
+'''
+Signal match rules
+
+receivers are only registered on the connection, the match rules that
+make the bus daemon route signals to this process are managed here:
+one per adapter, assigned device and notifying characteristic, dropped
+when BlueZ removes the object. unrelated BlueZ traffic (other devices'
+RSSI while scanning, ...) is never delivered. --match broad installs
+the former catch-all rules instead, for comparison.
+'''
+
+MATCH_NARROW = "narrow"
+MATCH_BROAD = "broad"
+
+match_mode = MATCH_NARROW
+match_rule_dict = dict()  # {key: match rule}, key is the watched path
+signal_count_dict = dict()  # {member: signals delivered}
+
+
+def match_rule(**keywords):
+    return ",".join("{}='{}'".format(key, value)
+                    for key, value in sorted(keywords.items()))
+
+
+def prop_match_rule(path, iface):
+    return match_rule(type='signal', sender=BLUEZ_SERVICE_NAME,
+                      interface=IFACE_DBUS_PROP,
+                      member='PropertiesChanged', path=path, arg0=iface)
+
+
+def match_error_cb(method, key, rule, error):
+    LOG.error("%s %s failed: %s", method, rule, error)
+    if method == 'AddMatch' and match_rule_dict.get(key, None) == rule:
+        del match_rule_dict[key]
 
-    LOG.info(path)
-    LOG.info(interfaces)
-    properties = interfaces["org.bluez.Device1"]
 
-    if not properties:
+def call_bus_match(method, key, rule):
+    # AddMatch/RemoveMatch on the bus daemon without blocking, unlike
+    # add_match_string_non_blocking a rejected rule is reported
+    bus.call_async(DBUS_SERVICE_NAME, DBUS_OBJECT_PATH, DBUS_SERVICE_NAME,
+                   method, 's', (rule,),
+                   reply_handler=lambda: None,
+                   error_handler=lambda e: match_error_cb(method, key, rule,
+                                                          e))
+
+
+def add_match(key, rule):
+    if key in match_rule_dict:
         return
+    LOG.debug("add match %s", rule)
+    match_rule_dict[key] = rule
+    call_bus_match('AddMatch', key, rule)
+
+
+def remove_match(key):
+    rule = match_rule_dict.pop(key, None)
+    if rule is not None:
+        LOG.debug("remove match %s", rule)
+        call_bus_match('RemoveMatch', key, rule)
+
+
+def watch_broad():
+    add_match('PropertiesChanged', match_rule(
+        type='signal', sender=BLUEZ_SERVICE_NAME,
+        interface=IFACE_DBUS_PROP, member='PropertiesChanged'))
+    for member in ('InterfacesAdded', 'InterfacesRemoved'):
+        add_match(member, match_rule(
+            type='signal', sender=BLUEZ_SERVICE_NAME,
+            interface=IFACE_DBUS_OM, member=member))
+
+
+def watch_adapter(adapter_path):
+    if match_mode != MATCH_NARROW:
+        return
+    add_match(adapter_path, prop_match_rule(adapter_path, IFACE_ADAPTER))
+    # objects added or removed below this adapter only; arg0path matches
+    # object paths, arg0namespace only bus names and interfaces
+    for member in ('InterfacesAdded', 'InterfacesRemoved'):
+        add_match((member, adapter_path), match_rule(
+            type='signal', sender=BLUEZ_SERVICE_NAME,
+            interface=IFACE_DBUS_OM, member=member, path='/',
+            arg0path=adapter_path + '/'))
+
+
+def watch_device(device_path):
+    if match_mode == MATCH_NARROW:
+        add_match(device_path, prop_match_rule(device_path, IFACE_DEVICE))
+
+
+def watch_chrc(chrc_path):
+    if match_mode == MATCH_NARROW:
+        add_match(chrc_path, prop_match_rule(chrc_path, IFACE_GATT_CHRC))
+
+
+def unwatch_path(object_path):
+    # the object and everything below it
+    prefix = object_path + '/'
+    for key in list(match_rule_dict.keys()):
+        path = key[1] if isinstance(key, tuple) else key
+        if path == object_path or path.startswith(prefix):
+            remove_match(key)
+
+
+def count_signal(connection, message):
+    if isinstance(message, dbus.lowlevel.SignalMessage):
+        member = message.get_member()
+        signal_count_dict[member] = signal_count_dict.get(member, 0) + 1
+    return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+
+def get_signal_counts():
+    return dict(signal_count_dict)
+
+
+def add_receiver(handler, **keywords):
+    # local dispatch only, BusConnection.add_signal_receiver would also
+    # add a match rule on the bus
+    dbus.connection.Connection.add_signal_receiver(bus, handler, **keywords)
+
+
+def register_signals():
+    bus.add_message_filter(count_signal)
+
+    add_receiver(interfaces_added, dbus_interface=IFACE_DBUS_OM,
+                 signal_name="InterfacesAdded")
+    add_receiver(interfaces_removed_cb, dbus_interface=IFACE_DBUS_OM,
+                 signal_name="InterfacesRemoved")
+
+    add_receiver(property_changed, dbus_interface=IFACE_DBUS_PROP,
+                 signal_name="PropertiesChanged", path_keyword="path")
+    add_receiver(device_prop_changed, dbus_interface=IFACE_DBUS_PROP,
+                 signal_name="PropertiesChanged", arg0=IFACE_DEVICE,
+                 path_keyword="path")
+    add_receiver(adapter_prop_changed, dbus_interface=IFACE_DBUS_PROP,
+                 signal_name="PropertiesChanged", arg0=IFACE_ADAPTER,
+                 path_keyword="path")
+
+    if match_mode == MATCH_BROAD:
+        watch_broad()
+
+
+def start_client(adapter_names=None, power_reset=POWER_RESET_AUTO):
+    register_signals()
+
+    # broad match rules are installed first so no update is lost while
+    # seeding, narrow ones follow the adapters and devices in use
+    if not seed_object_tree():
+        LOG.error("can't seed object tree")
+        exit()
+    mark_phase("object tree seeded")
+
+    if not select_adapters(adapter_names):
+        LOG.error("No adapter found")
+        exit()
+    for adapter_path in adapter_list:
+        watch_adapter(adapter_path)
+
+    start_pipeline()
+
+    # devices are configured once every adapter is powered
+    power_up_adapters(power_reset, configure_device)
+
+
+exit_status = 0
+
+
+def quit_mainloop(status=0):
+    # main() exits with status once mainloop.run() returns
+    global exit_status
+    exit_status = status
+    mainloop.quit()
 
 
 def signalHandler(signum, frame):
-    LOG.info("signum: {}".format(signum))
+    LOG.info("signum: %s", signum)
+    stop_parse_message_thread()
+    ble_gattcache.save()
     mainloop.quit()
     LOG.info("exit bye")
     exit()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="BLE client with BlueZ")
+    parser.add_argument("--bus", default="system",
+                        help="'system', 'session' or the address of a "
+                             "private bus (e.g. ble_fake_bluez.py)")
+    parser.add_argument("--adapter", action="append", metavar="NAME",
+                        help="adapter to use, e.g. hci0 (repeatable, "
+                             "default: all)")
+    parser.add_argument("--adapter-max-connections", type=int,
+                        default=ADAPTER_MAX_CONNECTIONS,
+                        help="devices assigned to one adapter at most")
+    parser.add_argument("--power-reset", default=POWER_RESET_AUTO,
+                        choices=[POWER_RESET_AUTO, POWER_RESET_ALWAYS,
+                                 POWER_RESET_NEVER],
+                        help="power cycle the adapters: 'auto' only when "
+                             "the health check fails (default)")
+    parser.add_argument("--log-interval", type=float, metavar="SEC",
+                        default=ble_parser.LOG_INTERVAL,
+                        help="log at most one measurement line per "
+                             "characteristic every SEC (0: every value)")
+    parser.add_argument("--gatt-cache", metavar="FILE",
+                        default=ble_gattcache.FILENAME,
+                        help="GATT layout and static values of known "
+                             "devices (default: %(default)s)")
+    parser.add_argument("--no-gatt-cache", action="store_true",
+                        help="always walk the services and read values")
+    parser.add_argument("--buffer-size", type=int,
+                        default=ble_buffer.CAPACITY,
+                        help="values buffered per characteristic")
+    parser.add_argument("--buffer-policy", choices=ble_buffer.POLICIES,
+                        help="when a buffer is full, for every "
+                             "characteristic (default: coalesce absolute "
+                             "values, drop-oldest otherwise)")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="serve Prometheus metrics on "
+                             "127.0.0.1:PORT/metrics")
+    parser.add_argument("--metrics-socket", metavar="PATH",
+                        help="serve Prometheus metrics on a Unix socket")
+    parser.add_argument("--match", default=MATCH_NARROW,
+                        choices=[MATCH_NARROW, MATCH_BROAD],
+                        help="D-Bus match rules per adapter/device/"
+                             "characteristic (default) or catch-all")
+    parser.add_argument("--rssi-floor", type=int, default=DISCOVERY_RSSI,
+                        help="discovery ignores advertisers below this dBm")
+    parser.add_argument("--connect-concurrency", type=int,
+                        default=CONNECT_CONCURRENCY,
+                        help="connection attempts in flight per adapter")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="decode in N worker processes instead of "
+                             "the parse thread (default: 0)")
+    parser.add_argument("--table", nargs='?', const=ble_table.FILENAME,
+                        metavar="FILE",
+                        help="keep the latest values in a shared table "
+                             "(default FILE: %(const)s)")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record received notifications to FILE")
+    parser.add_argument("--record-max-bytes", type=int,
+                        default=ble_capture.MAX_BYTES,
+                        help="rotate the recording beyond this size")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay a recording instead of using BlueZ")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, multiple of real time "
+                             "(0: as fast as possible)")
+    return parser.parse_args()
+
+
 def main():
     # signal.signal(signal.SIGINT, lambda n, f: mainloop.quit())
     # signal.signal(signal.SIGTERM, lambda n, f: mainloop.quit())
 
-    signal.signal(signal.SIGINT, signalHandler)
-    signal.signal(signal.SIGTERM, signalHandler)
+    args = parse_args()
+    if args.workers and args.record:
+        LOG.error("--record can't be used with --workers")
+        exit(1)
+    ble_parser.log_interval = args.log_interval
+    recv_message_queue.capacity = args.buffer_size
+    global buffer_policy
+    buffer_policy = args.buffer_policy
 
-    # Set up the main loop.
-    DBusGMainLoop(set_as_default=True)
-    global bus
-    bus = dbus.SystemBus()
-
-    global mainloop
-    GObject.threads_init()
-    mainloop = GObject.MainLoop()
-
-    reset_bluetooth_power()
+    if args.record:
+        start_capture(args.record, args.record_max_bytes)
 
-    om = get_object_manager()
-    om.connect_to_signal('InterfacesRemoved', interfaces_removed_cb)
+    if args.table:
+        global value_table
+        value_table = ble_table.Table.create(args.table)
 
-    bus.add_signal_receiver(interfaces_added,
-                            dbus_interface="org.freedesktop.DBus.Properties",
-                            signal_name="InterfacesAdded")
-
-    bus.add_signal_receiver(property_changed, bus_name="org.bluez",
-                            dbus_interface="org.freedesktop.DBus.Properties",
-                            signal_name="PropertiesChanged",
-                            path_keyword="path")
-    bus.add_signal_receiver(device_prop_changed,
-                            dbus_interface="org.freedesktop.DBus.Properties",
-                            signal_name="PropertiesChanged",
-                            arg0="org.bluez.Device1",
-                            path_keyword="path")
-
-    LOG.debug("kick parse_message_thread()")
-    t = threading.Thread(target=parse_message_thread, args=([]))
-    t.setDaemon(True)
-    t.start()
-
-    configure_device()
+    if args.replay:
+        replay_main(args.replay, args.speed)
+        return
 
-    LOG.info("mainloop.run()")
-    mainloop.run()
+    signal.signal(signal.SIGINT, signalHandler)
+    signal.signal(signal.SIGTERM, signalHandler)
+    install_log_level_signals(GObject.idle_add)
+
+    if not args.no_gatt_cache:
+        ble_gattcache.load(args.gatt_cache)
+
+    if args.metrics_port or args.metrics_socket:
+        ble_metrics.start_server(args.metrics_port, args.metrics_socket)
+
+    global adapter_max_connections
+    adapter_max_connections = args.adapter_max_connections
+    global connect_concurrency
+    connect_concurrency = args.connect_concurrency
+    global discovery_rssi
+    discovery_rssi = args.rssi_floor
+    global match_mode
+    match_mode = args.match
+    global worker_count
+    worker_count = args.workers
+
+    setup_mainloop(args.bus)
+
+    start_client(args.adapter, args.power_reset)
+
+    # a quit before run() would be lost, configure_device may fail early
+    if not exit_status:
+        LOG.info("mainloop.run()")
+        mainloop.run()
+
+    if exit_status:
+        stop_parse_message_thread()
+        ble_gattcache.save()
+        exit(exit_status)
 
 
 if __name__ == '__main__':
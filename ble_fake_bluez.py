@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import socket
+import struct
+
+import dbus
+import dbus.service
+try:
+    from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from dbus.mainloop.glib import DBusGMainLoop
+
+import ble_uuid as UUID
+from ble_util import LOG
+
+'''
+Fake BlueZ
+
+a stand-in org.bluez service for the session bus or a private bus.
+it implements enough of ObjectManager, Adapter1, Device1, GattService1
+and GattCharacteristic1 to simulate many HR and CSC sensors:
+
+  ./ble_fake_bluez.py --hrm 20 --csc 20 --rate 4
+  ./ble_client.py --bus session
+'''
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+
+IFACE_DBUS_OM = 'org.freedesktop.DBus.ObjectManager'
+IFACE_DBUS_PROP = 'org.freedesktop.DBus.Properties'
+
+IFACE_ADAPTER = 'org.bluez.Adapter1'
+IFACE_DEVICE = 'org.bluez.Device1'
+IFACE_GATT_SERVICE = 'org.bluez.GattService1'
+IFACE_GATT_CHRC = 'org.bluez.GattCharacteristic1'
+
+ERROR_FAILED = 'org.bluez.Error.Failed'
+ERROR_NOT_PERMITTED = 'org.bluez.Error.NotPermitted'
+
+MTU = 23
+
+options = None
+object_manager = None
+
+
+class BluezError(dbus.exceptions.DBusException):
+    def __init__(self, name, message=''):
+        dbus.exceptions.DBusException.__init__(self, message)
+        self._dbus_error_name = name
+
+
+def after(seconds, func, *args):
+    # one shot timer
+    def timeout_cb():
+        func(*args)
+        return False
+    return GObject.timeout_add(int(seconds * 1000), timeout_cb)
+
+
+'''
+D-Bus objects
+'''
+
+
+class PropObject(dbus.service.Object):
+
+    def __init__(self, bus, path):
+        self.path = path
+        self.props = dict()  # {iface: {name: value}}
+        dbus.service.Object.__init__(self, bus, path)
+
+    def set_props(self, iface, changed):
+        self.props[iface].update(changed)
+        self.PropertiesChanged(iface, changed, [])
+
+    @dbus.service.method(IFACE_DBUS_PROP, in_signature='ss',
+                         out_signature='v')
+    def Get(self, iface, name):
+        try:
+            return self.props[iface][name]
+        except KeyError:
+            raise BluezError('org.freedesktop.DBus.Error.InvalidArgs',
+                             "{}.{}".format(iface, name))
+
+    @dbus.service.method(IFACE_DBUS_PROP, in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, iface):
+        if iface not in self.props:
+            raise BluezError('org.freedesktop.DBus.Error.InvalidArgs', iface)
+        return self.props[iface]
+
+    @dbus.service.method(IFACE_DBUS_PROP, in_signature='ssv')
+    def Set(self, iface, name, value):
+        self.Get(iface, name)
+        self.set_props(iface, {name: value})
+
+    @dbus.service.signal(IFACE_DBUS_PROP, signature='sa{sv}as')
+    def PropertiesChanged(self, iface, changed, invalidated):
+        pass
+
+
+class ObjectManager(dbus.service.Object):
+
+    def __init__(self, bus):
+        self.objects = dict()  # {path: PropObject}
+        dbus.service.Object.__init__(self, bus, '/')
+
+    def add(self, obj):
+        self.objects[obj.path] = obj
+        self.InterfacesAdded(obj.path, obj.props)
+
+    def remove(self, obj):
+        self.objects.pop(obj.path, None)
+        self.InterfacesRemoved(obj.path, list(obj.props.keys()))
+        obj.remove_from_connection()
+
+    @dbus.service.method(IFACE_DBUS_OM, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return dict((path, obj.props) for path, obj in self.objects.items())
+
+    @dbus.service.signal(IFACE_DBUS_OM, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(IFACE_DBUS_OM, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
+class Adapter(PropObject):
+
+    def __init__(self, bus, index):
+        PropObject.__init__(self, bus, '/org/bluez/hci{}'.format(index))
+        self.devices = []
+        self.discovery_filter = dict()
+        self.props[IFACE_ADAPTER] = {
+            'Address': dbus.String('00:00:00:00:FF:{:02X}'.format(index)),
+            'Name': dbus.String('fake-hci{}'.format(index)),
+            'Powered': dbus.Boolean(True),
+            'Discovering': dbus.Boolean(False),
+            'UUIDs': dbus.Array([], signature='s'),
+        }
+
+    def set_props(self, iface, changed):
+        PropObject.set_props(self, iface, changed)
+        if iface == IFACE_ADAPTER and 'Powered' in changed and \
+           not changed['Powered']:
+            for device in self.devices:
+                device.disconnect()
+
+    @dbus.service.method(IFACE_ADAPTER)
+    def StartDiscovery(self):
+        if not self.props[IFACE_ADAPTER]['Powered']:
+            raise BluezError('org.bluez.Error.NotReady', 'powered off')
+        self.set_props(IFACE_ADAPTER, {'Discovering': dbus.Boolean(True)})
+        for device in self.devices:
+            device.advertise()
+
+    @dbus.service.method(IFACE_ADAPTER)
+    def StopDiscovery(self):
+        self.set_props(IFACE_ADAPTER, {'Discovering': dbus.Boolean(False)})
+
+    @dbus.service.method(IFACE_ADAPTER, in_signature='a{sv}')
+    def SetDiscoveryFilter(self, discovery_filter):
+        LOG.info("%s discovery filter %s", self.path, discovery_filter)
+        self.discovery_filter = discovery_filter
+
+    def discovering(self):
+        return bool(self.props[IFACE_ADAPTER]['Discovering'])
+
+
+class Device(PropObject):
+
+    def __init__(self, bus, adapter, index, kind):
+        address = '00:00:00:00:{:02X}:{:02X}'.format(index >> 8, index & 0xff)
+        path = '{}/dev_{}'.format(adapter.path, address.replace(':', '_'))
+        PropObject.__init__(self, bus, path)
+
+        self.bus = bus
+        self.adapter = adapter
+        self.kind = kind
+        self.services = []
+        self.advertising = False
+        self.disconnect_timer = None
+
+        service_uuid = UUID.SERVICE_HRM if kind == 'HRM' else \
+            UUID.SERVICE_SPEED
+        self.props[IFACE_DEVICE] = {
+            'Address': dbus.String(address),
+            'Name': dbus.String('Fake{}-{}'.format(kind, index)),
+            'Adapter': dbus.ObjectPath(adapter.path),
+            'Paired': dbus.Boolean(True),
+            'Connected': dbus.Boolean(False),
+            'ServicesResolved': dbus.Boolean(False),
+            'UUIDs': dbus.Array([service_uuid, UUID.SERVICE_DEVICE,
+                                 UUID.SERVICE_BATT], signature='s'),
+        }
+
+    def connected(self):
+        return bool(self.props[IFACE_DEVICE]['Connected'])
+
+    def advertise(self):
+        if self.advertising:
+            return
+        self.advertising = True
+        self.advertise_cb()
+
+    def advertise_cb(self):
+        # RSSI churn while the adapter is scanning
+        if not self.adapter.discovering():
+            self.advertising = False
+            return
+        if not self.connected():
+            rssi = random.randint(-95, -40)
+            if rssi >= self.adapter.discovery_filter.get('RSSI', -127):
+                self.set_props(IFACE_DEVICE, {'RSSI': dbus.Int16(rssi)})
+        after(random.uniform(0.5, 1.5) * options.rssi_interval,
+              self.advertise_cb)
+
+    @dbus.service.method(IFACE_DEVICE, async_callbacks=('reply', 'error'))
+    def Connect(self, reply, error):
+        if self.connected():
+            reply()
+            return
+        if random.random() < options.connect_fail:
+            after(options.connect_delay, error,
+                  BluezError(ERROR_FAILED, 'le-connection-abort-by-local'))
+            return
+
+        after(options.connect_delay, self.connect_done, reply)
+
+    def connect_done(self, reply):
+        self.set_props(IFACE_DEVICE, {'Connected': dbus.Boolean(True)})
+        reply()
+        after(options.resolve_delay, self.resolve_services)
+
+        if options.disconnect_interval > 0:
+            delay = random.expovariate(1.0 / options.disconnect_interval)
+            self.disconnect_timer = after(delay, self.forced_disconnect)
+
+    def forced_disconnect(self):
+        self.disconnect_timer = None
+        self.disconnect()
+
+    def resolve_services(self):
+        if not self.connected() or self.services:
+            return
+        build_gatt(self)
+        self.set_props(IFACE_DEVICE,
+                       {'ServicesResolved': dbus.Boolean(True)})
+
+    @dbus.service.method(IFACE_DEVICE)
+    def Disconnect(self):
+        self.disconnect()
+
+    def disconnect(self):
+        if not self.connected():
+            return
+        LOG.info("disconnect %s", self.path)
+        if self.disconnect_timer is not None:
+            GObject.source_remove(self.disconnect_timer)
+            self.disconnect_timer = None
+
+        self.set_props(IFACE_DEVICE,
+                       {'ServicesResolved': dbus.Boolean(False)})
+        for service in self.services:
+            for chrc in service.chrcs:
+                chrc.stop()
+                object_manager.remove(chrc)
+            object_manager.remove(service)
+        self.services = []
+        self.set_props(IFACE_DEVICE, {'Connected': dbus.Boolean(False)})
+
+
+class Service(PropObject):
+
+    def __init__(self, bus, device, index, uuid):
+        path = '{}/service{:04x}'.format(device.path, index)
+        PropObject.__init__(self, bus, path)
+        self.chrcs = []
+        self.props[IFACE_GATT_SERVICE] = {
+            'UUID': dbus.String(uuid),
+            'Device': dbus.ObjectPath(device.path),
+            'Primary': dbus.Boolean(True),
+        }
+
+
+class Characteristic(PropObject):
+
+    def __init__(self, bus, service, index, uuid, flags, value,
+                 generator=None):
+        path = '{}/char{:04x}'.format(service.path, index)
+        PropObject.__init__(self, bus, path)
+        self.generator = generator
+        self.timer = None
+        self.sock = None
+        self.props[IFACE_GATT_CHRC] = {
+            'UUID': dbus.String(uuid),
+            'Service': dbus.ObjectPath(service.path),
+            'Flags': dbus.Array(flags, signature='s'),
+            'Notifying': dbus.Boolean(False),
+            'Value': dbus.Array(value, signature='y'),
+        }
+        if options.acquire and 'notify' in flags:
+            self.props[IFACE_GATT_CHRC]['NotifyAcquired'] = \
+                dbus.Boolean(False)
+
+    @dbus.service.method(IFACE_GATT_CHRC, in_signature='a{sv}',
+                         out_signature='ay')
+    def ReadValue(self, read_options):
+        return self.props[IFACE_GATT_CHRC]['Value']
+
+    @dbus.service.method(IFACE_GATT_CHRC)
+    def StartNotify(self):
+        if self.props[IFACE_GATT_CHRC]['Notifying']:
+            return
+        self.set_props(IFACE_GATT_CHRC, {'Notifying': dbus.Boolean(True)})
+        self.start()
+
+    @dbus.service.method(IFACE_GATT_CHRC)
+    def StopNotify(self):
+        self.stop()
+
+    @dbus.service.method(IFACE_GATT_CHRC, in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, acquire_options):
+        if 'NotifyAcquired' not in self.props[IFACE_GATT_CHRC]:
+            raise BluezError(ERROR_NOT_PERMITTED, 'acquire not supported')
+        if self.sock is not None:
+            raise BluezError(ERROR_NOT_PERMITTED, 'already acquired')
+
+        self.sock, remote = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+        self.sock.setblocking(False)
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+
+        self.set_props(IFACE_GATT_CHRC,
+                       {'NotifyAcquired': dbus.Boolean(True)})
+        self.start()
+        return fd, dbus.UInt16(MTU)
+
+    def start(self):
+        if self.generator is None or self.timer is not None:
+            return
+        interval = int(1000 / options.rate)
+        self.timer = GObject.timeout_add(interval, self.notify)
+
+    def stop(self):
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+            self.timer = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if 'NotifyAcquired' in self.props[IFACE_GATT_CHRC]:
+            self.props[IFACE_GATT_CHRC]['NotifyAcquired'] = \
+                dbus.Boolean(False)
+        if self.props[IFACE_GATT_CHRC]['Notifying']:
+            self.set_props(IFACE_GATT_CHRC,
+                           {'Notifying': dbus.Boolean(False)})
+
+    def notify(self):
+        value = self.generator()
+        if self.sock is not None:
+            try:
+                self.sock.send(value)
+            except OSError as e:
+                LOG.info("acquired notify closed %s: %s", self.path, e)
+                self.stop()
+                return False
+            return True
+
+        self.set_props(IFACE_GATT_CHRC,
+                       {'Value': dbus.Array(value, signature='y')})
+        return True
+
+
+'''
+Sensors
+'''
+
+
+def hrm_generator():
+    state = {'bpm': random.randint(60, 150)}
+
+    def generate():
+        bpm = state['bpm'] + random.randint(-2, 2)
+        bpm = state['bpm'] = min(max(bpm, 40), 200)
+        rr = int(60.0 / bpm * 1024)
+        # uint8 bpm, contact detected, RR interval
+        return struct.pack('<BBH', 0x16, bpm, rr)
+    return generate
+
+
+def csc_generator():
+    state = {'wheel_rev': random.randint(0, 0xffffffff),
+             'wheel_time': 0.0,
+             'crank_rev': random.randint(0, 0xffff),
+             'crank_time': 0.0}
+    interval = 1.0 / options.rate
+
+    def generate():
+        state['wheel_rev'] += 3
+        state['wheel_time'] += interval * 1024
+        state['crank_rev'] += 1
+        state['crank_time'] += interval * 1024
+        return struct.pack('<BIHHH', 0x03,
+                           state['wheel_rev'] & 0xffffffff,
+                           int(state['wheel_time']) & 0xffff,
+                           state['crank_rev'] & 0xffff,
+                           int(state['crank_time']) & 0xffff)
+    return generate
+
+
+def add_service(device, uuid, chrc_list):
+    service = Service(device.bus, device, len(device.services) * 0x10,
+                      uuid)
+    object_manager.add(service)
+    for index, (chrc_uuid, flags, value, generator) in enumerate(chrc_list):
+        chrc = Characteristic(device.bus, service, index + 1, chrc_uuid,
+                              flags, value, generator)
+        service.chrcs.append(chrc)
+        object_manager.add(chrc)
+    device.services.append(service)
+
+
+def build_gatt(device):
+    name = str(device.props[IFACE_DEVICE]['Name'])
+    if device.kind == 'HRM':
+        add_service(device, UUID.SERVICE_HRM, [
+            (UUID.CHRC_HRM_HR_MEAS, ['notify'], [0, 0], hrm_generator()),
+            (UUID.CHRC_HRM_SNSR_LOC, ['read'], [1], None),
+        ])
+    else:
+        add_service(device, UUID.SERVICE_SPEED, [
+            (UUID.CHRC_SPEED_CSC_MEAS, ['notify'], [0], csc_generator()),
+            (UUID.CHRC_SPEED_CSC_FEAT, ['read'], [0x03, 0x00], None),
+            (UUID.CHRC_SNSR_LOC, ['read'], [0x0c], None),
+        ])
+    add_service(device, UUID.SERVICE_DEVICE, [
+        (UUID.CHRC_DEVICE_MODEL, ['read'], list(name.encode()), None),
+        (UUID.CHRC_DEVICE_SERIAL, ['read'],
+         list(device.path[-17:].encode()), None),
+        (UUID.CHRC_DEVICE_FW_REV, ['read'], list(b'1.0.0'), None),
+    ])
+    add_service(device, UUID.SERVICE_BATT, [
+        (UUID.CHRC_BATTERY_LEVEL, ['read', 'notify'],
+         [random.randint(20, 100)], None),
+    ])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="fake BlueZ service")
+    parser.add_argument("--bus", default="session",
+                        help="'session' or the address of a private bus")
+    parser.add_argument("--adapters", type=int, default=1,
+                        help="number of adapters (hci0, hci1, ...)")
+    parser.add_argument("--hrm", type=int, default=1,
+                        help="number of heart rate sensors")
+    parser.add_argument("--csc", type=int, default=1,
+                        help="number of speed and cadence sensors")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="notifications per second per sensor")
+    parser.add_argument("--connect-delay", type=float, default=0.5,
+                        help="[sec] Connect() to Connected")
+    parser.add_argument("--resolve-delay", type=float, default=0.5,
+                        help="[sec] Connected to ServicesResolved")
+    parser.add_argument("--connect-fail", type=float, default=0.0,
+                        help="probability that Connect() fails")
+    parser.add_argument("--disconnect-interval", type=float, default=0.0,
+                        help="[sec] mean time to a forced disconnect, "
+                             "0 disables")
+    parser.add_argument("--rssi-interval", type=float, default=1.0,
+                        help="[sec] RSSI update interval while scanning")
+    parser.add_argument("--acquire", action="store_true",
+                        help="support AcquireNotify")
+    return parser.parse_args()
+
+
+def connect_bus(address):
+    if address == 'session':
+        return dbus.SessionBus()
+    if address == 'system':
+        return dbus.SystemBus()
+    bus = dbus.bus.BusConnection(address)
+    return bus
+
+
+def main():
+    global options
+    global object_manager
+
+    options = parse_args()
+
+    DBusGMainLoop(set_as_default=True)
+    bus = connect_bus(options.bus)
+    name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+
+    object_manager = ObjectManager(bus)
+
+    # every adapter sees every sensor, as separate Device1 objects
+    kinds = ['HRM'] * options.hrm + ['SPEED'] * options.csc
+    for adapter_index in range(options.adapters):
+        adapter = Adapter(bus, adapter_index)
+        object_manager.add(adapter)
+        for index, kind in enumerate(kinds):
+            device = Device(bus, adapter, index + 1, kind)
+            adapter.devices.append(device)
+            object_manager.add(device)
+
+    LOG.info("fake bluez %s on %s: %s adapters %s devices",
+             name.get_name(), options.bus, options.adapters, len(kinds))
+
+    mainloop = GObject.MainLoop()
+    mainloop.run()
+
+
+if __name__ == '__main__':
+    main()
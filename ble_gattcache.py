@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import binascii
+
+import ble_uuid as UUID
+from ble_util import LOG
+
+'''
+GATT cache
+
+what the last configuration of a device found, kept on disk so a
+reconnect can enable notifications right away and skip reading values
+that never change:
+
+  {address: {"fw_rev": hex or None,
+             "chrcs": [[path below the device, uuid, flags], ...],
+             "values": {path below the device: hex}}}
+
+only values of STATIC_UUIDS are kept. the entry is dropped when the
+firmware revision read on a reconnect differs from the cached one.
+only used from the main loop.
+'''
+
+STATIC_UUIDS = frozenset([
+    UUID.CHRC_HRM_SNSR_LOC,
+    UUID.CHRC_SNSR_LOC,
+    UUID.CHRC_SPEED_CSC_FEAT,
+    UUID.CHRC_DEVICE_SYSTEM_ID,
+    UUID.CHRC_DEVICE_MODEL,
+    UUID.CHRC_DEVICE_SERIAL,
+    UUID.CHRC_DEVICE_FW_REV,
+    UUID.CHRC_DEVICE_HW_REV,
+    UUID.CHRC_DEVICE_SW_REV,
+    UUID.CHRC_DEVICE_MANFUC,
+])
+
+FILENAME = os.path.expanduser("~/.cache/ble_client/gatt_cache.json")
+
+filename = None  # None: cache disabled
+cache_dict = dict()
+dirty = False
+
+
+def is_static(uuid):
+    return uuid in STATIC_UUIDS
+
+
+def load(path=FILENAME):
+    global filename, cache_dict
+    filename = path
+    try:
+        with open(filename) as f:
+            cache_dict = json.load(f)
+    except FileNotFoundError:
+        cache_dict = dict()
+    except (OSError, ValueError) as e:
+        LOG.warning("ignore gatt cache %s: %s", filename, e)
+        cache_dict = dict()
+    LOG.info("gatt cache %s: %s devices", filename, len(cache_dict))
+
+
+def save():
+    global dirty
+    if filename is None or not dirty:
+        return
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = filename + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache_dict, f, indent=1, sort_keys=True)
+        os.replace(tmp, filename)
+    except OSError as e:
+        LOG.warning("can't save gatt cache %s: %s", filename, e)
+        return
+    dirty = False
+
+
+def enabled():
+    return filename is not None
+
+
+def get(address):
+    if filename is None:
+        return None
+    return cache_dict.get(address, None)
+
+
+def put(address, chrcs):
+    # a new layout, values and firmware revision start over
+    global dirty
+    if filename is None:
+        return
+    cache_dict[address] = {
+        "fw_rev": None,
+        "chrcs": [[relpath, str(uuid), [str(flag) for flag in flags]]
+                  for relpath, uuid, flags in chrcs],
+        "values": dict(),
+    }
+    dirty = True
+
+
+def remove(address):
+    global dirty
+    if cache_dict.pop(address, None) is not None:
+        dirty = True
+
+
+def get_value(address, relpath):
+    entry = get(address)
+    if entry is None:
+        return None
+    value = entry["values"].get(relpath, None)
+    if value is None:
+        return None
+    return binascii.unhexlify(value)
+
+
+def set_value(address, relpath, value):
+    global dirty
+    entry = get(address)
+    if entry is None:
+        return
+    value = binascii.hexlify(bytes(value)).decode('ascii')
+    if entry["values"].get(relpath, None) != value:
+        entry["values"][relpath] = value
+        dirty = True
+
+
+def check_fw_rev(address, value):
+    # False when the firmware changed, the entry is dropped then
+    global dirty
+    entry = get(address)
+    if entry is None:
+        return True
+
+    value = binascii.hexlify(bytes(value)).decode('ascii')
+    fw_rev = entry["fw_rev"]
+    entry["fw_rev"] = value
+    if fw_rev == value:
+        return True
+
+    dirty = True
+    if fw_rev is None:
+        return True
+    LOG.info("firmware of %s changed", address)
+    remove(address)
+    return False
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import threading
+import socketserver
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from ble_util import LOG
+
+'''
+Metrics registry
+
+counters, gauges and fixed-bucket histograms, exposed in the Prometheus
+text format. recording is a plain attribute update on an object the
+caller keeps (no lookup, no lock): every metric has a single writer
+thread, the exporter only reads.
+'''
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# [sec] parse / D-Bus call times
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                   0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+lock = threading.Lock()  # registration only
+metric_dict = dict()  # {(name, labels): metric}
+help_dict = dict()  # {name: (type, help)}
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in items) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func  # read at export time, for counts kept elsewhere
+
+    def inc(self, count=1):
+        self.value += count
+
+    def samples(self, name, labels):
+        value = self.value if self.func is None else self.func()
+        yield name + '_total', format_labels(labels), value
+
+
+class Gauge(object):
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func  # read at export time, e.g. queue.qsize
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.value if self.func is None else self.func()
+        yield name, format_labels(labels), value
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        bounds = list(self.buckets) + [float('inf')]
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield name + '_bucket', format_labels(
+                labels, ('le', format_value(bound))), total
+        yield name + '_sum', format_labels(labels), self.sum
+        yield name + '_count', format_labels(labels), total
+
+
+def register(metric_type, name, help, labels, factory):
+    # the same name and labels return the same metric
+    key = (name, label_key(labels))
+    with lock:
+        metric = metric_dict.get(key, None)
+        if metric is None:
+            help_dict.setdefault(name, (metric_type, help))
+            metric = factory()
+            metric_dict[key] = metric
+    return metric
+
+
+def counter(name, help='', func=None, **labels):
+    return register('counter', name, help, labels, lambda: Counter(func))
+
+
+def gauge(name, help='', func=None, **labels):
+    return register('gauge', name, help, labels, lambda: Gauge(func))
+
+
+def histogram(name, help='', buckets=LATENCY_BUCKETS, **labels):
+    return register('histogram', name, help, labels,
+                    lambda: Histogram(buckets))
+
+
+def export():
+    with lock:
+        items = sorted(metric_dict.items())
+
+    lines = []
+    last_name = None
+    for (name, labels), metric in items:
+        if name != last_name:
+            metric_type, help = help_dict[name]
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            last_name = name
+        for sample_name, sample_labels, value in metric.samples(name, labels):
+            lines.append('{}{} {}'.format(sample_name, sample_labels,
+                                          format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class Timer(object):
+    # with Timer(histogram): ...
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+'''
+Exporter
+
+GET /metrics on 127.0.0.1:<port> or on a Unix socket, served from a
+daemon thread
+'''
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = export().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is '' on a Unix socket
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        LOG.debug("metrics " + format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server(port=None, path=None):
+    if path is not None:
+        if os.path.exists(path):
+            os.unlink(path)
+        server = ThreadingUnixHTTPServer(path, MetricsHandler)
+        LOG.info("metrics on unix:%s", path)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        LOG.info("metrics on http://127.0.0.1:%s/metrics", port)
+
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+
+from ble_util import LOG
+
+'''
+Local mirror of the BlueZ ObjectManager tree
+
+seeded once from GetManagedObjects() and kept current from
+InterfacesAdded / InterfacesRemoved / PropertiesChanged signals
+'''
+
+lock = threading.RLock()
+
+objects = dict()        # {path: {iface: {prop: value}}}
+children_dict = dict()  # {(parent_path, iface): set([path, ...])}
+uuid_path_dict = dict()  # {(uuid, iface): set([path, ...])}
+
+
+def uuids_of(props):
+    uuid = props.get('UUID', None)
+    if uuid is not None:
+        return [str(uuid)]
+    return [str(uuid) for uuid in props.get('UUIDs', [])]
+
+
+def index_add(path, iface, props):
+    parent_key = (os.path.dirname(path), iface)
+    children_dict.setdefault(parent_key, set()).add(path)
+
+    for uuid in uuids_of(props):
+        uuid_path_dict.setdefault((uuid, iface), set()).add(path)
+
+
+def index_remove(path, iface, props):
+    parent_key = (os.path.dirname(path), iface)
+    children = children_dict.get(parent_key, None)
+    if children is not None:
+        children.discard(path)
+        if not children:
+            del children_dict[parent_key]
+
+    for uuid in uuids_of(props):
+        uuid_key = (uuid, iface)
+        paths = uuid_path_dict.get(uuid_key, None)
+        if paths is None:
+            continue
+        paths.discard(path)
+        if not paths:
+            del uuid_path_dict[uuid_key]
+
+
+def clear():
+    with lock:
+        objects.clear()
+        children_dict.clear()
+        uuid_path_dict.clear()
+
+
+def seed(managed_objects):
+    with lock:
+        clear()
+        for path, interfaces in managed_objects.items():
+            add_interfaces(path, interfaces)
+
+    LOG.info("seed object tree: %s objects", len(objects))
+
+
+def add_interfaces(path, interfaces):
+    path = str(path)
+    with lock:
+        obj = objects.setdefault(path, dict())
+        for iface, props in interfaces.items():
+            iface = str(iface)
+            old_props = obj.get(iface, None)
+            if old_props is not None:
+                index_remove(path, iface, old_props)
+            obj[iface] = dict(props)
+            index_add(path, iface, obj[iface])
+
+
+def remove_interfaces(path, interfaces):
+    path = str(path)
+    with lock:
+        obj = objects.get(path, None)
+        if obj is None:
+            return
+        for iface in interfaces:
+            iface = str(iface)
+            props = obj.pop(iface, None)
+            if props is not None:
+                index_remove(path, iface, props)
+        if not obj:
+            del objects[path]
+
+
+def update_properties(path, iface, changed, invalidated):
+    with lock:
+        obj = objects.get(path, None)
+        if obj is None:
+            return
+        props = obj.get(iface, None)
+        if props is None:
+            return
+
+        reindex = 'UUID' in changed or 'UUIDs' in changed
+        if reindex:
+            index_remove(path, iface, props)
+
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+
+        if reindex:
+            index_add(path, iface, props)
+
+
+'''
+Lookup
+'''
+
+
+def get_properties(path, iface):
+    with lock:
+        obj = objects.get(str(path), None)
+        if obj is None:
+            return None
+        props = obj.get(iface, None)
+        if props is None:
+            return None
+        return dict(props)
+
+
+def has_object(path):
+    with lock:
+        return str(path) in objects
+
+
+def get_paths(iface):
+    with lock:
+        return [path for path, obj in objects.items() if iface in obj]
+
+
+def get_children(parent_path, iface):
+    # returns [[path, uuid], ...] of the direct children of parent_path
+    with lock:
+        paths = children_dict.get((str(parent_path), iface), ())
+        return [[path, objects[path][iface].get('UUID', None)]
+                for path in sorted(paths)]
+
+
+def find_by_uuid(uuid, iface):
+    with lock:
+        return sorted(uuid_path_dict.get((str(uuid), iface), ()))
@@ -1,72 +1,188 @@
 #!/usr/bin/env python3
 
+import struct
+import time
+from collections import namedtuple
+
 import ble_uuid as UUID
 from ble_util import LOG
 
 '''
-parse message
+records
+
+every parser returns one of these, timestamp is time.monotonic() of
+reception
 '''
 
+Value = namedtuple('Value', ['id', 'timestamp', 'value'])
 
-def parse_string(id, value):
-    value_str = ''.join([chr(byte) for byte in value])
-    # value_str = value_str.encode('utf-8')
-    LOG.info("{}\t-> {}".format(id, value_str))
+# contact is None when the sensor has no contact detection, energy [kJ]
+# is None when not present, rr is a tuple of raw 1/1024 s intervals
+HrmMeas = namedtuple('HrmMeas', ['id', 'timestamp', 'bpm',
+                                 'contact', 'energy', 'rr'])
 
+# event times are raw 1/1024 s ticks, absent fields are None
+CscMeas = namedtuple('CscMeas', ['id', 'timestamp',
+                                 'wheel_rev', 'wheel_time',
+                                 'crank_rev', 'crank_time'])
 
-def parse_integer(id, value):
-    value_int = int.from_bytes(value, byteorder='little', signed=False)
+# derived from consecutive CscMeas by ble_calc.CscCalculator
+# speed [m/s], cadence [rpm], None while the sensor has no such data
+CscSpeed = namedtuple('CscSpeed', ['id', 'timestamp',
+                                   'speed', 'speed_avg',
+                                   'cadence', 'cadence_avg'])
 
-    LOG.info("{}\t -> {}".format(id, value_int))
+# derived from RR intervals by ble_calc.HrvCalculator
+# rmssd/sdnn [ms], pnn50 [%], None until the window has enough beats
+HrvStat = namedtuple('HrvStat', ['id', 'timestamp', 'count',
+                                 'rmssd', 'sdnn', 'pnn50'])
 
+# tuple.__new__ skips the keyword handling of the generated __new__
+new_record = tuple.__new__
 
-def parse_integer_signed(id, value):
-    value_int = int.from_bytes(value, byteorder='little', signed=True)
+'''
+precompiled formats
+'''
 
-    LOG.info("{}\t -> {}".format(id, value_int))
+FMT_UINT16 = struct.Struct('<H')
+FMT_CSC_WHEEL = struct.Struct('<IH')  # wheel rev, wheel time
+FMT_CSC_CRANK = struct.Struct('<HH')  # crank rev, crank time
 
+CSC_FLAG_WHEEL = 0x01
+CSC_FLAG_CRANK = 0x02
 
-def parse_binary(id, value):
-    value_array = [int(byte) for byte in value]
-    LOG.info("{}\t-> {}".format(id, value_array))
-    value = bytearray(value)  # Dbus.array -> byte array
+HRM_FLAG_UINT16 = 0x01
+HRM_FLAG_CONTACT = 0x02
+HRM_FLAG_CONTACT_SUPPORTED = 0x04
+HRM_FLAG_ENERGY = 0x08
+HRM_FLAG_RR = 0x10
 
+rr_fmt_dict = dict()  # {count: struct.Struct('<{count}H')}
 
-def parse_speed_csc_meas(id, value):
 
-    flags = value[0]
+def rr_fmt(count):
+    fmt = rr_fmt_dict.get(count, None)
+    if fmt is None:
+        fmt = struct.Struct('<{}H'.format(count))
+        rr_fmt_dict[count] = fmt
+    return fmt
 
-    wheel_status = flags & 0x01
+uint_fmt_dict = {
+    1: struct.Struct('<B'),
+    2: struct.Struct('<H'),
+    4: struct.Struct('<I'),
+    8: struct.Struct('<Q'),
+}
 
-    if wheel_status != 1:
-        LOG.warning("no wheel flag")
-        return
+sint_fmt_dict = {
+    1: struct.Struct('<b'),
+    2: struct.Struct('<h'),
+    4: struct.Struct('<i'),
+    8: struct.Struct('<q'),
+}
 
-    tmp = value[1:5]
-    wheel_rev = int.from_bytes(tmp, byteorder='little', signed=False)
 
-    tmp = value[5:7]
-    update_time = int.from_bytes(tmp, byteorder='little', signed=False)
-    update_time /= 1024.0
+def to_buffer(value):
+    # bytes from AcquireNotify are used as is, dbus.Array is packed once
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    return bytes(value)
 
-    LOG.info("{}\t-> wh_rev:{}\tupdate_time:{}".
-              format(id, wheel_rev, update_time))
 
+'''
+parse message
+'''
 
-def parse_hrm_meas(id, value):
 
-    flags = value[0]
+def parse_string(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    value_str = str(to_buffer(value), 'utf-8', 'replace').rstrip('\x00')
+    return new_record(Value, (id, timestamp, value_str))
+
+
+def parse_integer(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    buf = to_buffer(value)
+    fmt = uint_fmt_dict.get(len(buf), None)
+    if fmt is None:
+        value_int = int.from_bytes(buf, byteorder='little', signed=False)
+    else:
+        value_int = fmt.unpack_from(buf)[0]
+    return new_record(Value, (id, timestamp, value_int))
 
-    hr_value_fmt = flags & 0x01
 
-    if hr_value_fmt == 1:
-        tmp = value[1:3]
-        hrm_meas = int.from_bytes(tmp, byteorder='little', signed=False)
+def parse_integer_signed(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    buf = to_buffer(value)
+    fmt = sint_fmt_dict.get(len(buf), None)
+    if fmt is None:
+        value_int = int.from_bytes(buf, byteorder='little', signed=True)
     else:
-        tmp = value[1]
-        hrm_meas = int(tmp)
+        value_int = fmt.unpack_from(buf)[0]
+    return new_record(Value, (id, timestamp, value_int))
 
-    LOG.info("{}\t-> hr_meas = {} bpm".format(id, hrm_meas))
+
+def parse_binary(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    return new_record(Value, (id, timestamp, bytes(to_buffer(value))))
+
+
+def parse_speed_csc_meas(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    buf = to_buffer(value)
+
+    flags = buf[0]
+    offset = 1
+    if flags & CSC_FLAG_WHEEL:
+        wheel_rev, wheel_time = FMT_CSC_WHEEL.unpack_from(buf, offset)
+        offset += FMT_CSC_WHEEL.size
+    else:
+        wheel_rev = wheel_time = None
+
+    if flags & CSC_FLAG_CRANK:
+        crank_rev, crank_time = FMT_CSC_CRANK.unpack_from(buf, offset)
+    else:
+        crank_rev = crank_time = None
+
+    return new_record(CscMeas, (id, timestamp,
+                                wheel_rev, wheel_time, crank_rev, crank_time))
+
+
+def parse_hrm_meas(id, value, timestamp=None):
+    if timestamp is None:
+        timestamp = time.monotonic()
+    buf = to_buffer(value)
+
+    flags = buf[0]
+    if flags & HRM_FLAG_UINT16:
+        hrm_meas = FMT_UINT16.unpack_from(buf, 1)[0]
+        offset = 3
+    else:
+        hrm_meas = buf[1]
+        offset = 2
+
+    if flags & HRM_FLAG_CONTACT_SUPPORTED:
+        contact = bool(flags & HRM_FLAG_CONTACT)
+    else:
+        contact = None
+
+    if flags & HRM_FLAG_ENERGY:
+        energy = FMT_UINT16.unpack_from(buf, offset)[0]
+        offset += 2
+    else:
+        energy = None
+
+    if flags & HRM_FLAG_RR:
+        rr = rr_fmt((len(buf) - offset) >> 1).unpack_from(buf, offset)
+    else:
+        rr = ()
+
+    return new_record(HrmMeas, (id, timestamp, hrm_meas, contact, energy, rr))
 
 
 def from_bytes_sint8(value):
@@ -83,10 +199,85 @@ def from_bytes_sint16(value):
         return int.from_bytes(value[0:2], byteorder='little', signed=True)
 
 
-def parse_none(id, value):
-    LOG.error("Unknown UUID, id={}".format(id))
+def parse_none(id, value, timestamp=None):
+    LOG.error("Unknown UUID, id=%s", id)
+
+    return None
+
+
+'''
+sink
+
+parsed records are handed to every registered sink, logging is just one
+of them. log_sink writes at most one line per id and record type every
+log_interval seconds of reception time.
+'''
+
+LOG_INTERVAL = 1.0  # [sec]
+
+log_interval = LOG_INTERVAL
+log_time_dict = dict()  # {(id, record type): timestamp of the last line}
+
+
+def log_sink(record):
+    timestamp = record.timestamp
+    if timestamp is not None:
+        key = (record.id, type(record))
+        last = log_time_dict.get(key, None)
+        if last is not None and timestamp - last < log_interval:
+            return
+        log_time_dict[key] = timestamp
+
+    if isinstance(record, HrmMeas):
+        LOG.info("%s\t-> hr_meas = %s bpm\tcontact:%s\tenergy:%s\trr:%s",
+                 record.id,
+                 record.bpm,
+                 record.contact,
+                 record.energy,
+                 record.rr)
+    elif isinstance(record, HrvStat):
+        LOG.info("%s\t-> rmssd:%s\tsdnn:%s\tpnn50:%s\t(n=%s)",
+                 record.id,
+                 record.rmssd,
+                 record.sdnn,
+                 record.pnn50,
+                 record.count)
+    elif isinstance(record, CscMeas):
+        LOG.info("%s\t-> wh_rev:%s\twh_time:%s\tcr_rev:%s\tcr_time:%s",
+                 record.id,
+                 record.wheel_rev,
+                 record.wheel_time,
+                 record.crank_rev,
+                 record.crank_time)
+    elif isinstance(record, CscSpeed):
+        LOG.info("%s\t-> speed:%s(%s) m/s\tcadence:%s(%s) rpm",
+                 record.id,
+                 record.speed,
+                 record.speed_avg,
+                 record.cadence,
+                 record.cadence_avg)
+    else:
+        LOG.info("%s\t-> %s", record.id, record.value)
+
+
+sink_list = [log_sink]
+
 
-    return {id: [None, None]}
+def add_sink(sink):
+    if sink not in sink_list:
+        sink_list.append(sink)
+
+
+def remove_sink(sink):
+    if sink in sink_list:
+        sink_list.remove(sink)
+
+
+def emit(record):
+    if record is None:
+        return
+    for sink in sink_list:
+        sink(record)
 
 
 uuid_to_parser_dict = {
@@ -109,3 +300,12 @@ uuid_to_parser_dict = {
     # Battery
     UUID.CHRC_BATTERY_LEVEL: parse_integer,
 }
+
+
+def register_parser(uuid, parse_func):
+    # parse_func(id, value, timestamp) -> record, for a new profile
+    uuid_to_parser_dict[str(uuid).lower()] = parse_func
+
+
+def get_parser(uuid):
+    return uuid_to_parser_dict.get(uuid, None)
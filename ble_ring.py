@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import os
+import mmap
+import time
+import struct
+import select
+import signal
+import multiprocessing
+
+from ble_util import LOG, reinit_log_after_fork, stop_log
+
+'''
+Shared-memory ring buffer
+
+one single-producer single-consumer ring per worker process, in an
+anonymous shared mmap the worker inherits on fork. the producer (the
+D-Bus main loop) only copies frames in and moves head, the worker only
+moves tail; neither takes a lock. head and tail count bytes and never
+wrap, the position in the data area is the count & mask.
+
+  0   producer: head, dropped
+  64  consumer: tail, frames, latency total, latency max
+  128 sleeping, stopped
+  192 data, frames aligned to 8 bytes:
+
+      size (u32), kind (u16), index (u16), payload length (u16),
+      recv time, timestamp (double), payload
+
+a frame never wraps, the end of the data area is skipped with a PAD
+frame. a REGISTER frame carries "path\0id\0uuid" for index, DATA frames
+only the index. a sleeping worker is woken by one byte on a pipe.
+
+after the data area, the worker publishes metrics: doubles only the
+worker writes, read by the main process for its exporter.
+'''
+
+KIND_PAD = 0
+KIND_DATA = 1
+KIND_REGISTER = 2
+
+# native formats at 8-byte aligned offsets: every field the other side
+# reads is written with one 8-byte store, never byte by byte
+PRODUCER = struct.Struct('@QQ')  # head, dropped
+CONSUMER = struct.Struct('@QQdd')  # tail, frames, latency total, max
+FLAGS = struct.Struct('@QQ')  # sleeping, stopped
+COUNT = struct.Struct('@Q')
+FRAME = struct.Struct('<IHHH2xdd')
+FRAME_SIZE = struct.Struct('<IH')
+
+PRODUCER_OFFSET = 0
+CONSUMER_OFFSET = 64
+FLAGS_OFFSET = 128
+DATA_OFFSET = 192
+
+CAPACITY = 1 << 20  # [bytes] data area per worker, a power of two
+WAKE_TIMEOUT = 0.1  # [sec] backstop for a lost wakeup
+PUBLISH_FRAMES = 1024  # metrics are published at least this often
+NO_TIMESTAMP = float('nan')
+
+
+class Ring(object):
+
+    def __init__(self, capacity=CAPACITY, metrics=0):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two: {}".format(
+                capacity))
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.metrics_offset = DATA_OFFSET + capacity
+        self.metrics_fmt = struct.Struct('@{}d'.format(metrics))
+        self.mm = mmap.mmap(-1, self.metrics_offset + self.metrics_fmt.size)
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_w, False)
+        os.set_blocking(self.wake_r, False)
+        self.head = 0  # producer only
+        self.dropped = 0
+
+    '''producer'''
+
+    def put(self, kind, index, payload, recv_time=0.0,
+            timestamp=NO_TIMESTAMP):
+        # returns False when the ring is full and the frame was dropped
+        mm = self.mm
+        size = (FRAME.size + len(payload) + 7) & ~7
+        head = self.head
+        pos = head & self.mask
+        pad = self.capacity - pos if pos + size > self.capacity else 0
+        tail = COUNT.unpack_from(mm, CONSUMER_OFFSET)[0]
+        if head + pad + size - tail > self.capacity:
+            self.dropped += 1
+            PRODUCER.pack_into(mm, PRODUCER_OFFSET, head, self.dropped)
+            return False
+
+        if pad:
+            FRAME_SIZE.pack_into(mm, DATA_OFFSET + pos, pad, KIND_PAD)
+            head += pad
+            pos = 0
+        offset = DATA_OFFSET + pos
+        FRAME.pack_into(mm, offset, size, kind, index, len(payload),
+                        recv_time, timestamp)
+        offset += FRAME.size
+        mm[offset:offset + len(payload)] = payload
+
+        # the frame is complete before head moves past it
+        self.head = head + size
+        PRODUCER.pack_into(mm, PRODUCER_OFFSET, self.head, self.dropped)
+        if COUNT.unpack_from(mm, FLAGS_OFFSET)[0]:
+            self.wake()
+        return True
+
+    def wake(self):
+        COUNT.pack_into(self.mm, FLAGS_OFFSET, 0)
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass  # the pipe is full of wakeups already
+
+    def stop(self):
+        FLAGS.pack_into(self.mm, FLAGS_OFFSET, 0, 1)
+        self.wake()
+
+    '''consumer'''
+
+    def wait(self, tail):
+        # sleep until head moves past tail, False once stopped and empty
+        mm = self.mm
+        COUNT.pack_into(mm, FLAGS_OFFSET, 1)
+        if COUNT.unpack_from(mm, PRODUCER_OFFSET)[0] != tail:
+            COUNT.pack_into(mm, FLAGS_OFFSET, 0)
+            return True
+        if FLAGS.unpack_from(mm, FLAGS_OFFSET)[1]:
+            return False
+        select.select([self.wake_r], [], [], WAKE_TIMEOUT)
+        try:
+            os.read(self.wake_r, 4096)
+        except BlockingIOError:
+            pass
+        return True
+
+    def consume(self, handler, publish=None):
+        # handler(kind, index, payload, recv_time, timestamp) per frame,
+        # publish() when the ring runs empty and every PUBLISH_FRAMES
+        mm = self.mm
+        frames, latency_total, latency_max = 0, 0.0, 0.0
+        published = 0
+        tail = COUNT.unpack_from(mm, CONSUMER_OFFSET)[0]
+        while True:
+            head = COUNT.unpack_from(mm, PRODUCER_OFFSET)[0]
+            if head == tail or frames - published >= PUBLISH_FRAMES:
+                if publish is not None and frames != published:
+                    publish()
+                    published = frames
+            if head == tail:
+                if not self.wait(tail):
+                    return
+                continue
+
+            while tail != head:
+                offset = DATA_OFFSET + (tail & self.mask)
+                size, kind = FRAME_SIZE.unpack_from(mm, offset)
+                if size == 0:
+                    LOG.error("corrupt ring at %s, skip %s bytes", tail,
+                              head - tail)
+                    tail = head
+                    COUNT.pack_into(mm, CONSUMER_OFFSET, tail)
+                    break
+                if kind != KIND_PAD:
+                    size, kind, index, length, recv_time, timestamp = \
+                        FRAME.unpack_from(mm, offset)
+                    start = offset + FRAME.size
+                    payload = bytes(mm[start:start + length])
+                    if timestamp != timestamp:  # NaN
+                        timestamp = None
+                    handler(kind, index, payload, recv_time, timestamp)
+                    if kind == KIND_DATA:
+                        frames += 1
+                        latency = time.monotonic() - recv_time
+                        latency_total += latency
+                        if latency > latency_max:
+                            latency_max = latency
+                tail += size
+                CONSUMER.pack_into(mm, CONSUMER_OFFSET, tail, frames,
+                                   latency_total, latency_max)
+
+    def set_metrics(self, values):
+        self.metrics_fmt.pack_into(self.mm, self.metrics_offset, *values)
+
+    def get_metrics(self):
+        return self.metrics_fmt.unpack_from(self.mm, self.metrics_offset)
+
+    def stats(self):
+        head, dropped = PRODUCER.unpack_from(self.mm, PRODUCER_OFFSET)
+        tail, frames, latency_total, latency_max = CONSUMER.unpack_from(
+            self.mm, CONSUMER_OFFSET)
+        return {
+            "backlog": head - tail,
+            "dropped": dropped,
+            "frames": frames,
+            "latency_total": latency_total,
+            "latency_max": latency_max,
+        }
+
+
+'''
+Worker pool
+
+the rings are created, then the workers forked; a worker only sees the
+paths registered on its own ring. every characteristic of a device goes
+to the same worker, so per-device state (HRV windows, CSC deltas) lives
+in one process. devices go to the worker with the fewest devices.
+'''
+
+
+def worker_main(number, ring, handler, register, init, collect):
+    # handler(path, value, recv_time, timestamp) decodes one value,
+    # register(path, id, uuid) announces a path, init() runs first,
+    # collect() returns the metrics values to publish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    reinit_log_after_fork()
+    if init is not None:
+        init()
+    LOG.info("worker %s started", number)
+
+    path_dict = dict()  # {index: path}
+
+    def frame_handler(kind, index, payload, recv_time, timestamp):
+        if kind == KIND_DATA:
+            path = path_dict.get(index, None)
+            if path is not None:
+                handler(path, payload, recv_time, timestamp)
+        elif kind == KIND_REGISTER:
+            path, id, uuid = payload.decode('utf-8').split('\0')
+            path_dict[index] = path
+            register(path, id, uuid)
+
+    publish = None
+    if collect is not None:
+        def publish():
+            ring.set_metrics(collect())
+
+    try:
+        ring.consume(frame_handler, publish)
+        if publish is not None:
+            publish()
+        LOG.info("worker %s stopped", number)
+    finally:
+        stop_log()
+
+
+class WorkerPool(object):
+
+    def __init__(self, workers, handler, register, init=None,
+                 collect=None, metrics=0, capacity=CAPACITY):
+        # collect() returns metrics floats in a worker, see metrics()
+        self.handler = handler
+        self.register_func = register
+        self.init = init
+        self.collect = collect
+        self.rings = [Ring(capacity, metrics) for i in range(workers)]
+        self.processes = []
+        self.device_dict = dict()  # {device path: worker}
+        self.device_count = [0] * workers
+        self.path_dict = dict()  # {path: [worker, index, register frame]}
+
+    def start(self):
+        if self.collect is not None:
+            # a worker publishes once it decoded frames, until then the
+            # metrics read what collect() returns before any
+            initial = self.collect()
+            for ring in self.rings:
+                ring.set_metrics(initial)
+        for number, ring in enumerate(self.rings):
+            # the rings and handlers are inherited, never pickled: fork,
+            # whatever the platform default start method is
+            process = multiprocessing.get_context('fork').Process(
+                target=worker_main, name="worker{}".format(number),
+                args=(number, ring, self.handler, self.register_func,
+                      self.init, self.collect))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        LOG.info("started %s workers", len(self.processes))
+
+    def stop(self, timeout=None):
+        # workers decode what is still in their ring, then exit
+        for ring in self.rings:
+            ring.stop()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                LOG.warning("worker %s did not stop", process.name)
+                process.terminate()
+        self.processes = []
+
+    def worker_of(self, path):
+        # characteristic paths are <device>/serviceXXXX/charYYYY
+        device_path = path.split('/service', 1)[0]
+        worker = self.device_dict.get(device_path, None)
+        if worker is None:
+            worker = self.device_count.index(min(self.device_count))
+            self.device_dict[device_path] = worker
+            self.device_count[worker] += 1
+        return worker
+
+    def register(self, path, id, uuid):
+        entry = self.path_dict.get(path, None)
+        if entry is None:
+            entry = [self.worker_of(path), len(self.path_dict), None]
+            self.path_dict[path] = entry
+        entry[2] = '\0'.join((path, id, uuid)).encode('utf-8')
+
+    def put(self, path, value, recv_time, timestamp=NO_TIMESTAMP):
+        entry = self.path_dict.get(path, None)
+        if entry is None:
+            return False
+        ring = self.rings[entry[0]]
+        if entry[2] is not None:
+            # a dropped registration is sent again with the next value
+            if not ring.put(KIND_REGISTER, entry[1], entry[2]):
+                return False
+            entry[2] = None
+        return ring.put(KIND_DATA, entry[1], value, recv_time, timestamp)
+
+    def stats(self):
+        return [ring.stats() for ring in self.rings]
+
+    def metrics(self):
+        # the collect() values of every worker
+        return [ring.get_metrics() for ring in self.rings]
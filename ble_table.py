@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+
+import ble_parser
+from ble_util import LOG
+
+'''
+Latest-value table
+
+the latest decoded value of every device and characteristic in a file
+of fixed layout (in /dev/shm by default), for local processes that map
+it and poll at display rate. one slot per (id, kind):
+
+  header (64 bytes):
+    magic "BLET", version, slot size, slots, slots used (u32, native)
+
+  slot (SLOT_SIZE bytes, from offset HEADER_SIZE):
+    +0   sequence (u64)
+    +8   timestamp (double, time.monotonic() of reception), 4 values
+         (double, NaN when absent)
+    +64  kind (u16), 16-bit uuid (u16, 0 when none), id (56 bytes,
+         utf-8, NUL padded)
+
+  kind  values
+  HRM   bpm, energy [kJ], contact (1/0), last RR [1/1024 sec]
+  HRV   rmssd [ms], sdnn [ms], pnn50 [%], RR count
+  CSC   speed [m/s], speed avg, cadence [rpm], cadence avg
+  VALUE value (battery level, sensor location, ...)
+
+the main loop assigns the slots while configuring, only the decoder
+that owns a device (parse thread or worker) writes its values. the
+sequence is a seqlock: odd while the slot is written. a reader takes
+the sequence, the values, the sequence again, and retries when the two
+differ or are odd. readers never block the writer.
+'''
+
+MAGIC = b'BLET'
+VERSION = 2
+FILENAME = "/dev/shm/ble_client.table"
+SLOTS = 256
+SLOT_SIZE = 128
+HEADER_SIZE = 64
+ID_SIZE = 56  # <profile>_<address>_<chrc>, the rest of the slot
+READ_RETRY = 1000
+
+KIND_HRM = 1
+KIND_HRV = 2
+KIND_CSC = 3
+KIND_VALUE = 4
+KIND_NAMES = {
+    KIND_HRM: "hrm",
+    KIND_HRV: "hrv",
+    KIND_CSC: "csc",
+    KIND_VALUE: "value",
+}
+
+# native formats at 8-byte aligned offsets, see ble_ring
+HEADER = struct.Struct('@4sIIII')
+SEQ = struct.Struct('@Q')
+DATA = struct.Struct('@ddddd')  # timestamp, 4 values
+META = struct.Struct('@HH4x{}s'.format(ID_SIZE))
+USED_OFFSET = 16
+DATA_OFFSET = 8
+META_OFFSET = 64
+
+NAN = float('nan')
+
+# kinds a parser's records end up in, ble_calc adds HRV and CSC
+PARSER_KINDS = {
+    ble_parser.parse_hrm_meas: (KIND_HRM, KIND_HRV),
+    ble_parser.parse_speed_csc_meas: (KIND_CSC,),
+    ble_parser.parse_integer: (KIND_VALUE,),
+    ble_parser.parse_integer_signed: (KIND_VALUE,),
+}
+
+
+def number(value):
+    return NAN if value is None else float(value)
+
+
+def record_values(record):
+    # (kind, 4 values) of a record, None for records not in the table
+    record_type = type(record)
+    if record_type is ble_parser.HrmMeas:
+        return KIND_HRM, (number(record.bpm), number(record.energy),
+                          number(record.contact),
+                          float(record.rr[-1]) if record.rr else NAN)
+    if record_type is ble_parser.HrvStat:
+        return KIND_HRV, (number(record.rmssd), number(record.sdnn),
+                          number(record.pnn50), float(record.count))
+    if record_type is ble_parser.CscSpeed:
+        return KIND_CSC, (number(record.speed), number(record.speed_avg),
+                          number(record.cadence),
+                          number(record.cadence_avg))
+    if record_type is ble_parser.Value and \
+       isinstance(record.value, (int, float)):
+        return KIND_VALUE, (float(record.value), NAN, NAN, NAN)
+    return None
+
+
+class Table(object):
+
+    def __init__(self, mm, slots):
+        self.mm = mm
+        self.slots = slots
+        self.index_dict = dict()  # {(id, kind): slot}
+        self.miss_dict = dict()  # {(id, kind): slots used when not found}
+
+    @classmethod
+    def create(cls, filename=FILENAME, slots=SLOTS):
+        # a new, empty table replaces the file; readers still mapping the
+        # old one keep it until they open the table again
+        size = HEADER_SIZE + slots * SLOT_SIZE
+        tmp = filename + ".tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(mm, 0, MAGIC, VERSION, SLOT_SIZE, slots, 0)
+        os.replace(tmp, filename)
+        LOG.info("value table %s: %s slots", filename, slots)
+        return cls(mm, slots)
+
+    @classmethod
+    def open(cls, filename=FILENAME):
+        # read only, for consumers
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_size, slots, used = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            raise ValueError("not a value table: {}".format(filename))
+        return cls(mm, slots)
+
+    def used(self):
+        return HEADER.unpack_from(self.mm, 0)[4]
+
+    def meta(self, index):
+        kind, short, id = META.unpack_from(
+            self.mm, HEADER_SIZE + index * SLOT_SIZE + META_OFFSET)
+        return kind, short, id.rstrip(b'\0').decode('utf-8', 'replace')
+
+    def index(self, id, kind):
+        # slot of (id, kind), None when it has none
+        key = (id, kind)
+        index = self.index_dict.get(key, None)
+        if index is not None:
+            return index
+
+        # assigned in another process after this one was forked, looked
+        # for again only once more slots are used
+        used = self.used()
+        if self.miss_dict.get(key, None) == used:
+            return None
+        for i in range(used):
+            slot_kind, short, slot_id = self.meta(i)
+            if slot_kind == kind and slot_id == id:
+                self.index_dict[key] = i
+                return i
+        self.miss_dict[key] = used
+        return None
+
+    def alloc(self, id, kind, short=None):
+        index = self.index(id, kind)
+        if index is not None:
+            return index
+        id_bytes = id.encode('utf-8')
+        if len(id_bytes) > ID_SIZE:
+            # a cut id could collide and is never found again by index()
+            LOG.warning("id too long for the value table: %s", id)
+            return None
+        used = self.used()
+        if used >= self.slots:
+            LOG.warning("value table full, no slot for %s %s", id,
+                        KIND_NAMES[kind])
+            return None
+
+        offset = HEADER_SIZE + used * SLOT_SIZE
+        SEQ.pack_into(self.mm, offset, 0)
+        DATA.pack_into(self.mm, offset + DATA_OFFSET, NAN, NAN, NAN, NAN, NAN)
+        META.pack_into(self.mm, offset + META_OFFSET, kind, short or 0,
+                       id_bytes)
+        # the slot is complete before it is counted
+        struct.pack_into('@I', self.mm, USED_OFFSET, used + 1)
+        self.index_dict[(id, kind)] = used
+        return used
+
+    def write(self, index, timestamp, values):
+        mm = self.mm
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        seq = SEQ.unpack_from(mm, offset)[0]
+        SEQ.pack_into(mm, offset, seq + 1)
+        DATA.pack_into(mm, offset + DATA_OFFSET, timestamp, *values)
+        SEQ.pack_into(mm, offset, seq + 2)
+
+    def sink(self, record):
+        # ble_parser sink, runs in the decoder that owns the device
+        kind_values = record_values(record)
+        if kind_values is None:
+            return
+        index = self.index(record.id, kind_values[0])
+        if index is None:
+            return
+        timestamp = record.timestamp
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.write(index, timestamp, kind_values[1])
+
+    def read(self, index):
+        # (sequence, timestamp, values) of a consistent snapshot, None
+        # when the writer stopped in the middle of the slot
+        mm = self.mm
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        for retry in range(READ_RETRY):
+            seq = SEQ.unpack_from(mm, offset)[0]
+            if seq & 1:
+                continue
+            data = DATA.unpack_from(mm, offset + DATA_OFFSET)
+            if SEQ.unpack_from(mm, offset)[0] == seq:
+                return seq, data[0], data[1:]
+        return None
+
+    def read_all(self):
+        # [(id, kind name, short uuid, sequence, timestamp, values)]
+        rows = []
+        for index in range(self.used()):
+            kind, short, id = self.meta(index)
+            snapshot = self.read(index)
+            if snapshot is None:
+                continue
+            seq, timestamp, values = snapshot
+            rows.append((id, KIND_NAMES.get(kind, kind), short, seq,
+                         timestamp, values))
+        return rows
+
+
+'''
+dump the table, e.g. ./ble_table.py --interval 1
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ble_client value table")
+    parser.add_argument("filename", nargs='?', default=FILENAME)
+    parser.add_argument("--interval", type=float, default=0,
+                        help="print again every INTERVAL sec")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    while True:
+        # opened again each time, ble_client may have restarted
+        table = Table.open(args.filename)
+        now = time.monotonic()
+        for id, kind, short, seq, timestamp, values in table.read_all():
+            age = now - timestamp if timestamp == timestamp else NAN
+            print("{:48} {:5} 0x{:04x} seq:{:<8} age:{:8.3f} {}".format(
+                id, kind, short, seq, age,
+                ' '.join('{:.3f}'.format(value) for value in values)))
+        sys.stdout.flush()
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+        print()
+
+
+if __name__ == '__main__':
+    main()
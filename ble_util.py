@@ -2,10 +2,91 @@
 
 from logging import getLogger, basicConfig
 import logging
+import logging.handlers
+import atexit
+import os
+import queue
+import signal
 
 LOG_LEVEL = logging.INFO
 
-format = "%(asctime)s [%(levelname)7s] %(pathname)s(%(lineno)s)\tfn:%(funcName)30s(): %(message)s"
+'''
+logging
 
-basicConfig(format=format, level=LOG_LEVEL)
+records are put on a queue and written by a background thread, so the
+D-Bus main loop and the parse thread never wait for the terminal.
+the caller's file and function need a stack walk on every record, they
+are only logged with BLE_LOG_CALLER=1.
+'''
+
+if os.environ.get("BLE_LOG_CALLER"):
+    format = "%(asctime)s [%(levelname)7s] %(pathname)s(%(lineno)s)\tfn:%(funcName)30s(): %(message)s"
+else:
+    format = "%(asctime)s [%(levelname)7s] %(threadName)s: %(message)s"
+    logging._srcfile = None
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+log_queue = queue.Queue()
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter(format))
+listener = logging.handlers.QueueListener(log_queue, stream_handler)
+listener.start()
+atexit.register(listener.stop)
+
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+basicConfig(level=LOG_LEVEL, handlers=[queue_handler])
 LOG = getLogger(__name__)
+
+
+log_level_defer = None  # runs a function later, out of the signal handler
+
+
+def log_level_handler(signum, frame):
+    # logging here could deadlock on the queue lock the interrupted
+    # code holds, only the level changes and the log line is deferred
+    level = logging.DEBUG if signum == signal.SIGUSR1 else LOG_LEVEL
+    logging.getLogger().setLevel(level)
+    if log_level_defer is not None:
+        log_level_defer(log_level_changed, level)
+
+
+def log_level_changed(level):
+    LOG.warning("log level %s", logging.getLevelName(level))
+    return False
+
+
+def install_log_level_signals(defer=None):
+    # SIGUSR1: debug, SIGUSR2: back to LOG_LEVEL. defer(func, level) runs
+    # func(level) outside the handler, e.g. GObject.idle_add
+    global log_level_defer
+    log_level_defer = defer
+    signal.signal(signal.SIGUSR1, log_level_handler)
+    signal.signal(signal.SIGUSR2, log_level_handler)
+
+
+def reinit_log_after_fork():
+    # a forked worker has no listener thread, give it its own and name
+    # the process instead of the thread
+    global log_queue, listener, queue_handler
+    logging.logMultiprocessing = True
+    log_queue = queue.Queue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        format.replace("%(threadName)s", "%(processName)s")))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(queue_handler)
+
+
+def stop_log():
+    # write what is queued, a worker exits without atexit handlers
+    listener.stop()
@@ -64,6 +64,33 @@ uuid_to_key_dict = {
 }
 
 
+'''
+short UUIDs
+
+assigned numbers share the Bluetooth base UUID and differ only in 16
+bits; they are kept as int next to the 128-bit string
+'''
+
+BASE_UUID_PREFIX = '0000'
+BASE_UUID_SUFFIX = '-0000-1000-8000-00805f9b34fb'
+
+
+def short_uuid(uuid):
+    # 0x2a37 for '00002a37-0000-1000-8000-00805f9b34fb', None otherwise
+    uuid = str(uuid).lower()
+    if len(uuid) != 36 or not uuid.startswith(BASE_UUID_PREFIX) or \
+       not uuid.endswith(BASE_UUID_SUFFIX):
+        return None
+    try:
+        return int(uuid[4:8], 16)
+    except ValueError:
+        return None
+
+
+def full_uuid(short):
+    return '{}{:04x}{}'.format(BASE_UUID_PREFIX, short, BASE_UUID_SUFFIX)
+
+
 def uuid_to_key(val):
     if val not in uuid_to_key_dict:
         return None
@@ -72,3 +99,8 @@ def uuid_to_key(val):
 
 def is_valid_uuid(uuid):
     return uuid in uuid_to_key_dict
+
+
+def register_uuid(uuid, key):
+    # a new profile: uuid_to_key() knows it from now on
+    uuid_to_key_dict[str(uuid).lower()] = key